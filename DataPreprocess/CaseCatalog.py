@@ -0,0 +1,157 @@
+'''
+Case catalog in one SQLite file: labels, split membership, per-type file paths and roi geometry.
+Built once from label.csv, the split csv files, the npy / nii folders and the roi geometry index, then opened by the
+entry points instead of reading the csv files and listing the folders again:
+    preprocessing (CheckData.CropData3D, InferenceByCase.DataPreprocess): the case list and the crop centers;
+    training (CVTrain.EnsembleTrain): the cohort cases and the labels, the cross validation folds still come from
+        DataSpliter on alltrain_label.csv;
+    inference (InferenceByCase.Run, Inference.EnsembleInference): the split, the labels and the file paths.
+The case functions still read data_folder/{case}/{type}, nii_folder of the catalog must be that folder.
+OpenCatalog rebuilds the catalog when one of its sources (the csv files, the type folders, the nii case folders and
+the geometry index) is newer than it. The crop centers are only used while the roi files did not change since.
+CaseCatalog keeps the tables in dicts, every lookup is a hash lookup.
+'''
+import os
+import json
+import sqlite3
+
+import pandas as pd
+
+from DataPreprocess.CropCache import AtomicPath
+
+npy_type_list = ['Adc', 'Eser', 'T2', 'Roi', 'RoiDilated']
+nii_type_list = ['ADC_Reg.nii.gz', 'ESER_1.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii']
+
+
+def BuildCatalog(catalog_path, data_root, label_name='label.csv', split_list=('alltrain_label.csv', 'test.csv'),
+                 type_list=npy_type_list, nii_folder=None, nii_list=nii_type_list, geometry_path=None):
+    '''
+    data_root/label_name, data_root/{split} (the split name is the file name without .csv),
+    data_root/{type}/{case}.npy, nii_folder/{case}/{nii type} and the roi geometry index (DataPreprocess/RoiGeometry).
+    '''
+    label_df = pd.read_csv(os.path.join(data_root, label_name), index_col='CaseName')
+    label_rows = [(str(case), float(label)) for case, label in label_df['Label'].items()]
+
+    split_rows = []
+    for split_name in split_list:
+        split_path = os.path.join(data_root, split_name)
+        if not os.path.exists(split_path): continue
+        split_rows.extend([(os.path.splitext(split_name)[0], str(case))
+                           for case in pd.read_csv(split_path, index_col='CaseName').index])
+
+    path_rows = []
+    for data_type in type_list:
+        type_folder = os.path.join(data_root, data_type)
+        if not os.path.isdir(type_folder): continue
+        path_rows.extend([(one[:-len('.npy')], data_type, os.path.join(type_folder, one))
+                          for one in os.listdir(type_folder) if one.endswith('.npy')])
+    if nii_folder is not None:
+        for case in os.listdir(nii_folder):
+            case_folder = os.path.join(nii_folder, case)
+            if not os.path.isdir(case_folder): continue
+            file_set = set(os.listdir(case_folder))
+            path_rows.extend([(case, data_type, os.path.join(case_folder, data_type))
+                              for data_type in nii_list if data_type in file_set])
+
+    geometry_rows = []
+    if geometry_path is not None and os.path.exists(geometry_path):
+        geometry_df = pd.read_csv(geometry_path, index_col='CaseName')
+        # to_dict keeps the dtype of each column, iterrows would turn the integer mtime_ns into a float
+        geometry_rows = [(str(case), json.dumps(row)) for case, row in geometry_df.to_dict('index').items()]
+
+    with AtomicPath(catalog_path) as temp_path:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        with connection:
+            connection.execute('CREATE TABLE label (CaseName TEXT PRIMARY KEY, Label REAL)')
+            connection.execute('CREATE TABLE split (Split TEXT, CaseName TEXT, PRIMARY KEY (Split, CaseName))')
+            connection.execute('CREATE TABLE path (CaseName TEXT, Type TEXT, Path TEXT, PRIMARY KEY (CaseName, Type))')
+            connection.execute('CREATE TABLE geometry (CaseName TEXT PRIMARY KEY, Geometry TEXT)')
+            connection.executemany('INSERT OR REPLACE INTO label VALUES (?, ?)', label_rows)
+            connection.executemany('INSERT OR REPLACE INTO split VALUES (?, ?)', split_rows)
+            connection.executemany('INSERT OR REPLACE INTO path VALUES (?, ?, ?)', path_rows)
+            connection.executemany('INSERT OR REPLACE INTO geometry VALUES (?, ?)', geometry_rows)
+        connection.close()
+    print('{} labels, {} split rows, {} paths, {} geometries'.format(len(label_rows), len(split_rows), len(path_rows),
+                                                                   len(geometry_rows)))
+    return CaseCatalog(catalog_path)
+
+
+def CatalogSources(data_root, label_name='label.csv', split_list=('alltrain_label.csv', 'test.csv'),
+                   type_list=npy_type_list, nii_folder=None, geometry_path=None, **kwargs):
+    ''' the files and folders BuildCatalog reads, a new npy or nii file changes the mtime of its folder '''
+    source_list = [os.path.join(data_root, label_name)] + [os.path.join(data_root, one) for one in split_list] + \
+                  [os.path.join(data_root, one) for one in type_list]
+    if nii_folder is not None:
+        source_list.append(nii_folder)
+        source_list.extend([entry.path for entry in os.scandir(nii_folder) if entry.is_dir()])
+    if geometry_path is not None:
+        source_list.append(geometry_path)
+    return source_list
+
+
+def OpenCatalog(catalog_path, data_root, **kwargs):
+    ''' the catalog of BuildCatalog(catalog_path, data_root, **kwargs), built again if a source is newer than it '''
+    if os.path.exists(catalog_path):
+        catalog_mtime = os.stat(catalog_path).st_mtime_ns
+        newer_list = [one for one in CatalogSources(data_root, **kwargs)
+                      if os.path.exists(one) and os.stat(one).st_mtime_ns > catalog_mtime]
+        if len(newer_list) == 0:
+            return CaseCatalog(catalog_path)
+        print('catalog rebuilt, {} sources changed, e.g. {}'.format(len(newer_list), newer_list[0]))
+    return BuildCatalog(catalog_path, data_root, **kwargs)
+
+
+class CaseCatalog():
+    def __init__(self, catalog_path):
+        connection = sqlite3.connect('file:{}?mode=ro'.format(catalog_path), uri=True)
+        try:
+            self.label = dict(connection.execute('SELECT CaseName, Label FROM label'))
+            self.split = {}
+            for split_name, case in connection.execute('SELECT Split, CaseName FROM split'):
+                self.split.setdefault(split_name, set()).add(case)
+            self.path = {(case, data_type): path for case, data_type, path
+                         in connection.execute('SELECT CaseName, Type, Path FROM path')}
+            self.geometry = {case: json.loads(geometry) for case, geometry
+                             in connection.execute('SELECT CaseName, Geometry FROM geometry')}
+        finally:
+            connection.close()
+
+    def Cases(self, split_name=None):
+        ''' sorted case names of a split, or of all the labeled cases '''
+        return sorted(self.split[split_name] if split_name is not None else self.label)
+
+    def InSplit(self, case, split_name):
+        return case in self.split.get(split_name, ())
+
+    def Label(self, case):
+        return self.label[case]
+
+    def Path(self, case, data_type):
+        ''' None if the case has no file of data_type '''
+        return self.path.get((case, data_type))
+
+    def Geometry(self, case):
+        return self.geometry.get(case)
+
+    def TypeCases(self, data_type):
+        ''' sorted cases that have a file of data_type '''
+        return sorted([case for case, one_type in self.path if one_type == data_type])
+
+    def Centers(self, roi_name):
+        '''
+        {case: center} of the geometry table, as RoiGeometry.CenterDict, for the cases with a roi_name file.
+        None if a roi has no geometry or changed since (size, mtime_ns), the caller then runs BuildGeometryIndex.
+        '''
+        from DataPreprocess.RoiGeometry import GeometryCenter
+        center_dict = {}
+        for case in self.TypeCases(roi_name):
+            geometry = self.geometry.get(case)
+            if geometry is None or 'mtime_ns' not in geometry:
+                return None
+            stat = os.stat(self.Path(case, roi_name))
+            if int(geometry['size']) != stat.st_size or int(geometry['mtime_ns']) != stat.st_mtime_ns:
+                return None
+            center_dict[case] = GeometryCenter(geometry)
+        return center_dict
@@ -0,0 +1,73 @@
+'''
+One container per case: all modalities, the roi and the dilated roi of a case in one uncompressed npz,
+with a json meta entry (channel names, shape, dtype and the source folder).
+Reading a sample opens one file instead of one npy per modality folder.
+'''
+import os
+import json
+import numpy as np
+
+
+def SaveContainer(container_path, data_dict, **meta):
+    meta['channel'] = list(data_dict.keys())
+    meta['shape'] = {key: list(np.shape(value)) for key, value in data_dict.items()}
+    meta['dtype'] = {key: str(np.asarray(value).dtype) for key, value in data_dict.items()}
+    temp_path = container_path + '.tmp.npz'
+    np.savez(temp_path, meta=np.array(json.dumps(meta)), **data_dict)
+    os.replace(temp_path, container_path)
+
+
+def LoadContainer(container_path, channel_list=None):
+    ''' return {channel: array}, meta. Only the channels in channel_list are read if it is given. '''
+    with np.load(container_path) as container:
+        meta = json.loads(str(container['meta']))
+        if channel_list is None:
+            channel_list = meta['channel']
+        data_dict = {channel: container[channel] for channel in channel_list}
+    return data_dict, meta
+
+
+def _SourceStat(data_root, folder_list, case_file):
+    ''' {folder: [size, mtime_ns]} of the source npys of a case '''
+    stat_dict = {}
+    for folder in folder_list:
+        stat = os.stat(os.path.join(data_root, folder, case_file))
+        stat_dict[folder] = [stat.st_size, stat.st_mtime_ns]
+    return stat_dict
+
+
+def _ReadMeta(container_path):
+    try:
+        with np.load(container_path) as container:
+            return json.loads(str(container['meta']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def ConvertToContainer(data_root, container_root, type_list=('Adc', 'Eser', 'T2'), roi_list=('Roi', 'RoiDilated')):
+    '''
+    data_root/{type}/{case}.npy -> container_root/{case}.npz, the cases are taken from the last folder of roi_list.
+    The meta keeps the size and mtime_ns of the source npys, a case is converted again when they changed (e.g. the
+    npys were cropped again with another crop_shape), the unchanged cases are skipped.
+    '''
+    if not os.path.exists(container_root):
+        os.mkdir(container_root)
+    folder_list = list(type_list) + list(roi_list)
+    for case_file in sorted(os.listdir(os.path.join(data_root, folder_list[-1]))):
+        if not case_file.endswith('.npy'): continue
+        case = case_file[:-len('.npy')]
+        container_path = os.path.join(container_root, '{}.npz'.format(case))
+
+        try:
+            source_stat = _SourceStat(data_root, folder_list, case_file)
+        except FileNotFoundError as e:
+            print('{}: {}'.format(case, e))
+            continue
+        if os.path.exists(container_path):
+            meta = _ReadMeta(container_path)
+            if meta is not None and meta.get('source_stat') == source_stat: continue
+
+        data_dict = {folder: np.load(os.path.join(data_root, folder, case_file)) for folder in folder_list}
+        SaveContainer(container_path, data_dict, case=case, source=data_root, source_stat=source_stat)
+        print(case)
+# ConvertToContainer(r'/home/zhangyihong/Documents/BreastNpy', r'/home/zhangyihong/Documents/BreastNpy/Container')
@@ -0,0 +1,73 @@
+'''
+Run a per-case preprocessing function over a process pool, one case per task.
+Finished cases are recorded in a manifest csv, so a re-run only processes the missing or failed cases.
+'''
+import os
+import csv
+import time
+import traceback
+from functools import partial
+from multiprocessing import Pool
+
+
+class CaseManifest():
+    header = ['CaseName', 'Status', 'Time', 'Error']
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        if not os.path.exists(manifest_path):
+            with open(manifest_path, 'w', newline='') as f:
+                csv.writer(f).writerow(self.header)
+
+    def Status(self):
+        ''' the last recorded status of each case '''
+        status = {}
+        with open(self.manifest_path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                status[row['CaseName']] = row['Status']
+        return status
+
+    def Finished(self):
+        return {case for case, status in self.Status().items() if status == 'done'}
+
+    def Record(self, case, status, elapsed, error=''):
+        with open(self.manifest_path, 'a', newline='') as f:
+            csv.writer(f).writerow([case, status, '{:.2f}'.format(elapsed), error])
+
+
+def _RunOneCase(case_func, kwargs, case):
+    start = time.time()
+    try:
+        case_func(case, **kwargs)
+        return case, 'done', time.time() - start, ''
+    except Exception:
+        return case, 'failed', time.time() - start, traceback.format_exc()
+
+
+def RunCasePool(case_list, case_func, manifest_path, n_workers=4, is_resume=True, **kwargs):
+    '''
+    case_func(case, **kwargs) must be a module level function so it can be pickled to the workers.
+    A failed case is recorded and reported, the other cases keep running.
+    With is_resume, the cases already done in the manifest are skipped.
+    '''
+    manifest = CaseManifest(manifest_path)
+    finished = manifest.Finished() if is_resume else set()
+    todo_list = [case for case in case_list if case not in finished]
+    print('{} cases, {} finished before, {} to do'.format(len(case_list), len(case_list) - len(todo_list), len(todo_list)))
+
+    done_list, failed_list = [], []
+    start = time.time()
+    with Pool(n_workers) as pool:
+        for case, status, elapsed, error in pool.imap_unordered(partial(_RunOneCase, case_func, kwargs), todo_list):
+            manifest.Record(case, status, elapsed, error)
+            if status == 'done':
+                done_list.append(case)
+                print('{}: {:.1f}s'.format(case, elapsed))
+            else:
+                failed_list.append(case)
+                print('{}: failed after {:.1f}s\n{}'.format(case, elapsed, error))
+
+    print('done {}, failed {}, total {:.1f}s'.format(len(done_list), len(failed_list), time.time() - start))
+    if failed_list:
+        print('failed cases: {}'.format(failed_list))
+    return done_list, failed_list
@@ -0,0 +1,254 @@
+'''
+Work queue on a shared folder, so several machines can preprocess one cohort without a broker.
+queue_folder/lock/{case}: claimed by one worker (created with O_EXCL), its mtime is renewed while the case runs.
+    A lock older than lease seconds belongs to a crashed worker and can be taken over.
+queue_folder/done/{case}.json, queue_folder/failed/{case}.json: the result of the last worker that ran the case.
+    A failed case is retried (retry_failed) only if it failed before this run started, so the other workers and
+    machines of the same run do not run it again.
+    A done marker only counts for the same run: the same case function and parameters (RunFingerprint) and, when the
+    case function reads data_folder/{case}, the same source files (SourceStamp). Another crop_shape, target_spacing or
+    changed niis run the case again, its cache then decides what is rebuilt.
+The case function must be idempotent (e.g. the crop cache and atomic writes), a case that ran twice after a lease
+takeover gives the same outputs.
+'''
+import os
+import json
+import hashlib
+import time
+import random
+import socket
+import threading
+import traceback
+import uuid
+from functools import partial
+from multiprocessing import Pool
+
+from DataPreprocess.CropCache import AtomicPath
+
+
+def _Marker(queue_folder, state, case):
+    return os.path.join(queue_folder, state, '{}.json'.format(case))
+
+
+def RunFingerprint(case_func, kwargs):
+    content = json.dumps({'func': '{}.{}'.format(case_func.__module__, case_func.__qualname__), 'kwargs': kwargs},
+                         sort_keys=True, default=str)
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def SourceStamp(case, kwargs):
+    ''' the latest mtime (ns) of the files in data_folder/{case}, None if the case function has no data_folder '''
+    if 'data_folder' not in kwargs:
+        return None
+    case_folder = os.path.join(kwargs['data_folder'], case)
+    if not os.path.isdir(case_folder):
+        return None
+    return max([entry.stat().st_mtime_ns for entry in os.scandir(case_folder) if entry.is_file()], default=0)
+
+
+def _ReadMarker(queue_folder, state, case):
+    try:
+        with open(_Marker(queue_folder, state, case), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _IsDone(queue_folder, case, fingerprint, stamp):
+    record = _ReadMarker(queue_folder, 'done', case)
+    return record is not None and record.get('Fingerprint') == fingerprint and record.get('Source') == stamp
+
+
+def _IsFailed(queue_folder, case, fingerprint, run_start, retry_failed):
+    ''' the case failed with the same fingerprint, in this run (started at run_start) or in any run if not retry_failed '''
+    record = _ReadMarker(queue_folder, 'failed', case)
+    if record is None or record.get('Fingerprint') != fingerprint:
+        return False
+    return not retry_failed or record.get('Finished', 0) >= run_start
+
+
+def _WriteJson(file_path, content):
+    with AtomicPath(file_path) as temp_path:
+        with open(temp_path, 'w') as f:
+            json.dump(content, f)
+
+
+class CaseLock():
+    '''
+    The lock file holds the owner and a token unique to this lock. The heartbeat renews it and __exit__ removes it only
+    while it still holds the token, so a worker never renews or removes the lock of another one.
+    '''
+    def __init__(self, queue_folder, case, lease=600):
+        self.lock_path = os.path.join(queue_folder, 'lock', case)
+        self.lease = lease
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.token = '{} {}'.format(self.owner, uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _Create(self):
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.token)
+        return True
+
+    @staticmethod
+    def _Read(lock_path):
+        ''' (token, mtime) of a lock file, None if it does not exist '''
+        try:
+            with open(lock_path, 'r') as f:
+                token = f.read()
+            return token, os.stat(lock_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _IsOwner(self):
+        state = self._Read(self.lock_path)
+        return state is not None and state[0] == self.token
+
+    def Acquire(self):
+        if self._Create():
+            return True
+        state = self._Read(self.lock_path)
+        if state is None:
+            return self._Create()
+        if time.time() - state[1] <= self.lease:
+            return False
+
+        # several workers may judge the same lock expired: the rename moves away whatever lock is there now, which is
+        # checked afterwards to be the expired one (same token and mtime), otherwise it is put back
+        stale_path = '{}.{}.stale'.format(self.lock_path, self.token.replace(' ', '_').replace(':', '_'))
+        try:
+            os.rename(self.lock_path, stale_path)
+        except OSError:
+            return False
+        if self._Read(stale_path) != state:
+            try:
+                os.link(stale_path, self.lock_path)
+            except OSError:
+                # another worker created a lock meanwhile, the moved one is lost, its owner keeps running the case
+                # but will not remove the new lock
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return self._Create()
+
+    def _Heartbeat(self):
+        while not self._stop.wait(self.lease / 3):
+            if not self._IsOwner():
+                continue
+            try:
+                os.utime(self.lock_path, None)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._Heartbeat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        # the lock is renewed until here, so it cannot have expired and been taken over since the check
+        if self._IsOwner():
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+
+def _QueueWorker(worker_index, case_list, case_func, queue_folder, lease, retry_failed, run_start, kwargs):
+    # every worker walks the cases in its own order, so they rarely race for the same lock
+    case_list = list(case_list)
+    random.Random('{}{}{}'.format(socket.gethostname(), os.getpid(), worker_index)).shuffle(case_list)
+
+    fingerprint = RunFingerprint(case_func, kwargs)
+    done_count, failed_count = 0, 0
+    for case in case_list:
+        stamp = SourceStamp(case, kwargs)
+        if _IsDone(queue_folder, case, fingerprint, stamp) or \
+                _IsFailed(queue_folder, case, fingerprint, run_start, retry_failed):
+            continue
+        lock = CaseLock(queue_folder, case, lease=lease)
+        if not lock.Acquire():
+            continue
+
+        with lock:
+            if _IsDone(queue_folder, case, fingerprint, stamp) or \
+                    _IsFailed(queue_folder, case, fingerprint, run_start, retry_failed):
+                continue
+            start = time.time()
+            record = {'CaseName': case, 'Worker': lock.owner, 'Fingerprint': fingerprint, 'Source': stamp}
+            try:
+                case_func(case, **kwargs)
+                record.update({'Status': 'done', 'Time': time.time() - start, 'Error': ''})
+                _WriteJson(_Marker(queue_folder, 'done', case), record)
+                if os.path.exists(_Marker(queue_folder, 'failed', case)):
+                    os.remove(_Marker(queue_folder, 'failed', case))
+                done_count += 1
+                print('{} {}: {:.1f}s'.format(lock.owner, case, record['Time']))
+            except Exception:
+                record.update({'Status': 'failed', 'Time': time.time() - start, 'Error': traceback.format_exc(),
+                               'Finished': time.time()})
+                _WriteJson(_Marker(queue_folder, 'failed', case), record)
+                failed_count += 1
+                print('{} {}: failed\n{}'.format(lock.owner, case, record['Error']))
+    return done_count, failed_count
+
+
+def RunCaseQueue(case_list, case_func, queue_folder, n_workers=4, lease=600, retry_failed=True, run_start=None,
+                 **kwargs):
+    '''
+    Start the same call on every machine with the same queue_folder. Each machine runs n_workers processes that claim
+    the cases which are not done yet. lease (seconds) must be much longer than the clock skew between the machines.
+    run_start: the start of the run, the cases that failed since then are not retried; by default the time of this
+        call, pass the same value on every machine when they are not started together.
+    '''
+    for state in ['lock', 'done', 'failed']:
+        if not os.path.exists(os.path.join(queue_folder, state)):
+            os.makedirs(os.path.join(queue_folder, state), exist_ok=True)
+
+    worker = partial(_QueueWorker, case_list=case_list, case_func=case_func, queue_folder=queue_folder, lease=lease,
+                     retry_failed=retry_failed, run_start=time.time() if run_start is None else run_start,
+                     kwargs=kwargs)
+    start = time.time()
+    with Pool(n_workers) as pool:
+        count_list = pool.map(worker, range(n_workers))
+    print('this machine: done {}, failed {}, total {:.1f}s'.format(sum([one[0] for one in count_list]),
+                                                                   sum([one[1] for one in count_list]),
+                                                                   time.time() - start))
+    return MergeQueue(queue_folder, case_list, fingerprint=RunFingerprint(case_func, kwargs))
+
+
+def MergeQueue(queue_folder, case_list, manifest_path=None, fingerprint=None):
+    '''
+    Collect the done / failed markers of all machines. A case counts once whatever the number of workers that ran it.
+    With fingerprint (RunFingerprint), the markers of the other runs count as not done.
+    '''
+    from DataPreprocess.CasePool import CaseManifest
+    done_list, failed_list, todo_list = [], [], []
+    record_list = []
+    for case in case_list:
+        for state, state_list in [('done', done_list), ('failed', failed_list)]:
+            record = _ReadMarker(queue_folder, state, case)
+            if record is not None and (fingerprint is None or record.get('Fingerprint') == fingerprint):
+                record_list.append(record)
+                state_list.append(case)
+                break
+        else:
+            todo_list.append(case)
+
+    if manifest_path is None:
+        manifest_path = os.path.join(queue_folder, 'queue_manifest.csv')
+    with AtomicPath(manifest_path) as temp_path:
+        manifest = CaseManifest(temp_path)
+        for record in record_list:
+            manifest.Record(record['CaseName'], record['Status'], record['Time'], record['Error'])
+
+    print('all machines: done {}, failed {}, not done {}'.format(len(done_list), len(failed_list), len(todo_list)))
+    return done_list, failed_list
@@ -9,6 +9,8 @@ from MeDIT.Visualization import Imshow3DArray
 from MeDIT.ArrayProcess import ExtractBlock
 from MeDIT.SaveAndLoad import LoadImage
 
+from DataPreprocess.RoiGeometry import RoiGeometry, GeometryCenter, BuildGeometryIndex, CenterDict
+
 
 def GetCenter(roi):
     roi = np.squeeze(roi)
@@ -21,12 +23,7 @@ def GetCenter(roi):
 
 
 def GetCenter3D(roi):
-    roi = np.squeeze(roi)
-
-    non_zero = np.nonzero(roi)
-    center_y = int(np.median(np.unique(non_zero[0])))
-    center_x = int(np.median(np.unique(non_zero[1])))
-    center_z = int(np.median(np.unique(non_zero[2])))
+    center_y, center_x, center_z = GeometryCenter(RoiGeometry(roi))
     return (center_x, center_y, center_z)
 
 
@@ -121,39 +118,19 @@ def CropROI():
 
 
 
-def Statistical():
-    data_folder = r'V:\jzhang\breastFormatNew'
-    for case in os.listdir(data_folder):
-        case_folder = os.path.join(data_folder, case)
-        if not os.path.isdir(case_folder):
-            continue
-        else:
-            '''ESER_1.nii.gz, ADC_Reg.nii.gz, t2_W_Reg.nii.gz.....roi3D.nii'''
-            eser, _, _ = LoadImage(os.path.join(case_folder, 'ESER_1.nii.gz'), is_show_info=False)
-            adc, _, _ = LoadImage(os.path.join(case_folder, 'ADC_Reg.nii.gz'), is_show_info=False)
-            t2_W, _, _ = LoadImage(os.path.join(case_folder, 't2_W_Reg.nii.gz'), is_show_info=False)
-            roi, _, _ = LoadImage(os.path.join(case_folder, 'roi3D.nii'), is_show_info=False)
-            if not (eser.GetSize() == adc.GetSize() == t2_W.GetSize() == roi.GetSize()):
-                print('Size: {}'.format(case))
-            # if not (eser.GetDirection() == adc.GetDirection() == t2_W.GetDirection() == roi.GetDirection()):
-            #     print('Direction: {}'.format(case))
-            if not (eser.GetSpacing() == adc.GetSpacing() == t2_W.GetSpacing() == roi.GetSpacing()):
-                print('Spacing: {}'.format(case))
-            if not (eser.GetOrigin() == adc.GetOrigin() == t2_W.GetOrigin() == roi.GetOrigin()):
-                print('Origin: {}'.format(case))
+def Statistical(data_folder=r'V:\jzhang\breastFormatNew', save_path=r'V:\yhzhang\geometry_audit.csv'):
+    '''ESER_1.nii.gz, ADC_Reg.nii.gz, t2_W_Reg.nii.gz.....roi3D.nii, only the headers are read'''
+    from DataPreprocess.HeaderAudit import AuditCohort
+    return AuditCohort(data_folder, ['ESER_1.nii.gz', 'ADC_Reg.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii'],
+                       save_path=save_path)
 # Statistical()
 
 
-def StatisticalSpacing():
-    data_folder = r'V:\jzhang\breastFormatNew'
-    for case in os.listdir(data_folder):
-        case_folder = os.path.join(data_folder, case)
-        if not os.path.isdir(case_folder):
-            continue
-        else:
-            '''ESER_1.nii.gz, ADC_Reg.nii.gz, t2_W_Reg.nii.gz.....roi3D.nii'''
-            eser, _, _ = LoadImage(os.path.join(case_folder, 'ESER_1.nii.gz'), is_show_info=False)
-            print('{} {}'.format(eser.GetSpacing(), case))
+def StatisticalSpacing(data_folder=r'V:\jzhang\breastFormatNew'):
+    from DataPreprocess.HeaderAudit import AuditCohort
+    audit_df = AuditCohort(data_folder, ['ESER_1.nii.gz'])
+    for _, row in audit_df.iterrows():
+        print('{} {}'.format(row['spacing'], row['CaseName']))
 
 # StatisticalSpacing()
 
@@ -176,29 +153,14 @@ def LoadData(type_list):
             yield case, image_list, data_list
 
 
-def Shape():
-    slice_list = []
-    height_list = []
-    width_list = []
-    case_list = []
-    for case, image, data in LoadData('roi3D.nii'):
-        # if case != 'A191_GE CHUN YIN':
-        #     continue
-        height = list(sorted(set(np.nonzero(data)[0])))
-        width = list(sorted(set(np.nonzero(data)[1])))
-        slice = list(sorted(set(np.nonzero(data)[2])))
-
-        height_list.append(height[-1] - height[0])
-        width_list.append(width[-1] - width[0])
-        slice_list.append(slice[-1] - slice[0])
-        case_list.append(case)
-    print(sorted(slice_list))
-    print(sorted(height_list))
-    print(sorted(width_list))
-    # print(case_list[slice_list.index(max(slice_list))],
-    #       case_list[height_list.index(max(height_list))],
-    #       case_list[width_list.index(max(width_list))])
-    print()
+def Shape(data_folder=r'\\mega\\homesall\jzhang\breastFormatNew',
+          save_folder=r'\\mega\\homesall\jzhang\BreastProject', coverage=0.95):
+    '''
+    the roi extent percentiles of (height, width, slice) per spacing group, and the smallest crop shape that holds
+    coverage of the lesions (DataPreprocess/CropShape)
+    '''
+    from DataPreprocess.CropShape import AnalyzeExtent
+    return AnalyzeExtent(data_folder, save_folder, coverage=coverage)
 # Shape()
 
 
@@ -213,57 +175,101 @@ def TestCrop():
 # TestCrop()
 
 
-def CropData3D():
-    from MeDIT.ArrayProcess import ExtractBlock
-    from MeDIT.Normalize import NormalizeZ
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\dwi_b50')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\e_peak_1')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\msi_1')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\sep_1')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\si_slope_1')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\t1_peak_reset')
-    os.mkdir(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\t1_pre_reset')
-    for case, image_list, data_list in LoadData(['dwi_b50_Reg.nii.gz', 'e_peak_1.nii.gz', 'msi_1.nii.gz',
-                                                 'sep_1.nii.gz', 'si_slope_1.nii.gz',
-                                                 't1_peak_reset.nii.gz', 't1_pre_reset.nii.gz',
-                                                 'roi3D.nii']):
-        print(case)
-        dwi_b50 = data_list[0]
-        e_peak_1 = data_list[1]
-        msi_1 = data_list[2]
-        sep_1 = data_list[3]
-        si_slope_1 = data_list[0]
-        t1_peak_reset = data_list[1]
-        t1_pre_reset = data_list[2]
-
-        roi = data_list[-1]
+def CropCase3D(case, data_folder, save_folder, type_list, folder_list, crop_shape=(100, 100, 50), geometry=None,
+               mirror_folder=None):
+    '''
+    type_list[-1] must be roi, folder_list[i] is the save folder of type_list[i].
+    Only the outputs whose source files or crop_shape changed since the last run are rebuilt.
+    geometry: {case: center} of the roi geometry index (RoiGeometry.CenterDict), otherwise the roi is loaded.
+    With mirror_folder (DataPreprocess/NiiMirror), only the crop block of each volume is read.
+    The outputs are written with temp file + rename, so a case can be run again by another worker (CaseQueue).
+    '''
+    from DataPreprocess.CropStack import CropStack
+    from DataPreprocess.CropCache import CaseCache, SaveNpy
+
+    case_folder = os.path.join(data_folder, case)
+    roi_path = os.path.join(case_folder, type_list[-1])
+    cache = CaseCache(os.path.join(save_folder, 'crop_cache'), case)
+
+    key_list = [cache.Key([os.path.join(case_folder, data_type), roi_path], crop_shape=crop_shape)
+                for data_type in type_list[:-1]]
+    output_list = [os.path.join(save_folder, folder, '{}.npy'.format(case)) for folder in folder_list]
+    stale_list = [index for index in range(len(folder_list))
+                  if not cache.IsValid(folder_list[index], key_list[index], output_list[index])]
+    if len(stale_list) == 0:
+        cache.Save()
+        return
+
+    if mirror_folder is not None:
+        from DataPreprocess.NiiMirror import MirrorCase, LoadMirror
+        MirrorCase(case, data_folder, mirror_folder, [type_list[index] for index in stale_list])
+        data_list = [LoadMirror(mirror_folder, case, type_list[index]) for index in stale_list]
+    else:
+        data_list = [LoadImage(os.path.join(case_folder, type_list[index]), is_show_info=False)[1] for index in stale_list]
+    if geometry is not None and case in geometry:
+        y, x, z = geometry[case]
+    else:
+        _, roi, _ = LoadImage(roi_path, is_show_info=False)
         x, y, z = GetCenter3D(roi)
-        crop_dwi_b50, _ = ExtractBlock(dwi_b50, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_e_peak_1, _ = ExtractBlock(e_peak_1, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_msi_1, _ = ExtractBlock(msi_1, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_sep_1, _ = ExtractBlock(sep_1, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_si_slope_1, _ = ExtractBlock(si_slope_1, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_t1_peak_reset, _ = ExtractBlock(t1_peak_reset, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-        crop_t1_pre_reset, _ = ExtractBlock(t1_pre_reset, (100, 100, 50), center_point=(y, x, z), is_shift=True)
-
-
-        crop_dwi_b50 = crop_dwi_b50.transpose((2, 0, 1))
-        crop_e_peak_1 = crop_e_peak_1.transpose((2, 0, 1))
-        crop_msi_1 = crop_msi_1.transpose((2, 0, 1))
-        crop_sep_1 = crop_sep_1.transpose((2, 0, 1))
-        crop_si_slope_1 = crop_si_slope_1.transpose((2, 0, 1))
-        crop_t1_peak_reset = crop_t1_peak_reset.transpose((2, 0, 1))
-        crop_t1_pre_reset = crop_t1_pre_reset.transpose((2, 0, 1))
-
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\dwi_b50', '{}.npy'.format(case)), NormalizeZ(crop_dwi_b50))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\e_peak_1', '{}.npy'.format(case)), NormalizeZ(crop_e_peak_1))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\msi_1', '{}.npy'.format(case)), NormalizeZ(crop_msi_1))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\sep_1', '{}.npy'.format(case)), NormalizeZ(crop_sep_1))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\si_slope_1', '{}.npy'.format(case)), NormalizeZ(crop_si_slope_1))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\t1_peak_reset', '{}.npy'.format(case)), NormalizeZ(crop_t1_peak_reset))
-        np.save(os.path.join(r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect\t1_pre_reset', '{}.npy'.format(case)), NormalizeZ(crop_t1_pre_reset))
-
-CropData3D()
+    stack = CropStack(data_list, (y, x, z), crop_shape)
+    for index, crop in zip(stale_list, stack):
+        SaveNpy(output_list[index], crop)
+        cache.Update(folder_list[index], key_list[index])
+    cache.Save()
+
+
+def CropData3D(data_folder=r'\\mega\\homesall\jzhang\breastFormatNew',
+               save_folder=r'\\mega\\homesall\jzhang\BreastProject\BreastNpyCorrect',
+               crop_shape=(100, 100, 50), n_workers=8, mirror_folder=None, queue_folder=None, lease=600,
+               target_spacing=None, catalog=None):
+    '''
+    With catalog (DataPreprocess/CaseCatalog, nii_folder = data_folder), the cases with a roi and the crop centers are
+    read from it instead of listing data_folder and scanning the rois.
+    With queue_folder on a shared drive, run the same call on several machines, each claims the cases not done yet
+    (DataPreprocess/CaseQueue). Without it, the cases run on a local process pool.
+    With target_spacing (x, y, z mm), the cohort is first resampled to save_folder/Resampled (DataPreprocess/Resample)
+    and cropped from there, crop_shape is then in voxels of target_spacing.
+    '''
+    from DataPreprocess.CasePool import RunCasePool
+    from DataPreprocess.CaseQueue import RunCaseQueue
+
+    type_list = ['dwi_b50_Reg.nii.gz', 'e_peak_1.nii.gz', 'msi_1.nii.gz', 'sep_1.nii.gz', 'si_slope_1.nii.gz',
+                 't1_peak_reset.nii.gz', 't1_pre_reset.nii.gz', 'roi3D.nii']
+    folder_list = ['dwi_b50', 'e_peak_1', 'msi_1', 'sep_1', 'si_slope_1', 't1_peak_reset', 't1_pre_reset']
+    for folder in folder_list:
+        if not os.path.exists(os.path.join(save_folder, folder)):
+            os.makedirs(os.path.join(save_folder, folder), exist_ok=True)
+
+    # the crop cache skips the unchanged cases, every case is checked so a new crop_shape is picked up
+    if catalog is not None:
+        case_list = catalog.TypeCases(type_list[-1])
+    else:
+        case_list = [case for case in sorted(os.listdir(data_folder)) if os.path.isdir(os.path.join(data_folder, case))]
+    if target_spacing is not None:
+        from DataPreprocess.Resample import ResampleCase, ResampleCohort
+        resample_folder = os.path.join(save_folder, 'Resampled')
+        if queue_folder is not None:
+            RunCaseQueue(case_list, ResampleCase, os.path.join(queue_folder, 'Resample'), n_workers=n_workers,
+                         lease=lease, data_folder=data_folder, save_folder=resample_folder, type_list=type_list,
+                         target_spacing=target_spacing)
+        else:
+            ResampleCohort(data_folder, resample_folder, type_list, target_spacing, n_workers=n_workers)
+        data_folder = resample_folder
+
+    # the catalog centers are only used while its rois did not change, otherwise the index is updated
+    geometry = catalog.Centers(type_list[-1]) if catalog is not None and target_spacing is None else None
+    if geometry is None:
+        geometry = CenterDict(BuildGeometryIndex(data_folder, os.path.join(save_folder, 'roi_geometry.csv'),
+                                                 roi_name=type_list[-1], n_workers=n_workers))
+    case_kwargs = dict(data_folder=data_folder, save_folder=save_folder, type_list=type_list, folder_list=folder_list,
+                       crop_shape=crop_shape, geometry=geometry, mirror_folder=mirror_folder)
+    if queue_folder is not None:
+        return RunCaseQueue(case_list, CropCase3D, queue_folder, n_workers=n_workers, lease=lease, **case_kwargs)
+    return RunCasePool(case_list, CropCase3D, os.path.join(save_folder, 'crop_manifest.csv'), n_workers=n_workers,
+                       is_resume=False, **case_kwargs)
+
+if __name__ == '__main__':
+    CropData3D()
 
 
 # from MeDIT.Visualization import FlattenImages
@@ -282,4 +288,4 @@ CropData3D()
 #     plt.axis('off')
 #     plt.show()
     # plt.savefig(os.path.join(r'V:\yhzhang\BreastNpy\Image', '{}.jpg'.format(case.split('.npy')[0])))
-    # plt.close()
\ No newline at end of file
+    # plt.close()
@@ -0,0 +1,87 @@
+'''
+Content-addressed cache of the cropped outputs.
+Each output (e.g. Adc/Case.npy) is keyed by the hash of its source files and the crop / attention map parameters,
+so a re-run only rebuilds the outputs whose sources or parameters changed.
+'''
+import os
+import json
+import socket
+import hashlib
+import contextlib
+
+import numpy as np
+
+
+def FileDigest(file_path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextlib.contextmanager
+def AtomicPath(output_path):
+    '''
+    Yields a temp path next to output_path (unique per host and process), renamed onto output_path when the block ends
+    without error, so a crashed or concurrent writer never leaves a partial file. The temp file is removed on error.
+    '''
+    temp_path = '{}.{}.{}.tmp'.format(output_path, socket.gethostname(), os.getpid())
+    try:
+        yield temp_path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, output_path)
+
+
+def SaveNpy(output_path, data):
+    with AtomicPath(output_path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            np.save(f, data)
+
+
+class CaseCache():
+    '''
+    One json record per case in cache_folder, so the cases can be processed in parallel without sharing a file.
+    The file digests are memorized with (size, mtime), an unchanged file is not read again.
+    '''
+    def __init__(self, cache_folder, case):
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder, exist_ok=True)
+        self.record_path = os.path.join(cache_folder, '{}.json'.format(case))
+        self.record = {'digest': {}, 'key': {}}
+        if os.path.exists(self.record_path):
+            try:
+                with open(self.record_path, 'r') as f:
+                    self.record = json.load(f)
+            except ValueError:
+                pass
+
+    def Digest(self, file_path):
+        stat = os.stat(file_path)
+        memo = self.record['digest'].get(file_path)
+        if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime:
+            return memo[2]
+        digest = FileDigest(file_path)
+        self.record['digest'][file_path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def Key(self, file_list, **params):
+        sha = hashlib.sha1()
+        for file_path in file_list:
+            sha.update(self.Digest(file_path).encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def IsValid(self, name, key, output_path):
+        return self.record['key'].get(name) == key and os.path.exists(output_path)
+
+    def Update(self, name, key):
+        self.record['key'][name] = key
+
+    def Save(self):
+        with AtomicPath(self.record_path) as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump(self.record, f, indent=1)
@@ -0,0 +1,119 @@
+'''
+Lesion extent statistics from the roi geometry index and the roi headers, and the smallest crop shape that covers a
+target fraction of the lesions. The crop is centered at the geometry center, so a lesion fits in a crop of
+2 * max(center - min, max - center) + 1 voxels along each axis. Axes are (height, width, slice) of the nii arrays,
+the same order as crop_shape in CheckData.CropData3D.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+from DataPreprocess.RoiGeometry import axis_name, BuildGeometryIndex
+
+percentile_list = [50, 75, 90, 95, 99, 100]
+
+
+def RequiredShape(geometry_df):
+    ''' (n_case, 3) voxels a crop centered at the geometry center needs to hold the whole lesion '''
+    center = geometry_df[['center_' + name for name in axis_name]].values
+    lower = center - geometry_df[['min_' + name for name in axis_name]].values
+    upper = geometry_df[['max_' + name for name in axis_name]].values - center
+    return 2 * np.maximum(lower, upper) + 1
+
+
+def ExtentTable(data_folder, index_path, roi_name='roi3D.nii', n_workers=8, decimals=2):
+    '''
+    One row per case: extent_* (voxels), required_* (centered crop, voxels), spacing_* (mm), required_mm_* and
+    SpacingGroup (spacing rounded to decimals).
+    '''
+    from DataPreprocess.HeaderAudit import AuditCohort
+    geometry_df = BuildGeometryIndex(data_folder, index_path, roi_name=roi_name, n_workers=n_workers)
+    audit_df = AuditCohort(data_folder, [roi_name], n_workers=n_workers * 2)
+    audit_df = audit_df[audit_df['Error'] == ''].set_index('CaseName')
+
+    extent_df = pd.DataFrame(index=geometry_df.index)
+    required = RequiredShape(geometry_df)
+    spacing = np.full(required.shape, np.nan)
+    known = geometry_df.index.isin(audit_df.index)
+    if known.any():
+        # nii spacing is (x, y, z), the arrays are (height, width, slice) = (y, x, z)
+        xyz = np.array(audit_df.loc[geometry_df.index[known], 'spacing'].tolist(), dtype=float)
+        spacing[known] = xyz[:, [1, 0, 2]]
+    for index, name in enumerate(axis_name):
+        extent_df['extent_' + name] = geometry_df['extent_' + name].values + 1
+        extent_df['required_' + name] = required[:, index]
+        extent_df['spacing_' + name] = spacing[:, index]
+        extent_df['required_mm_' + name] = required[:, index] * spacing[:, index]
+    extent_df['SpacingGroup'] = ['x'.join(['{:.{}f}'.format(one, decimals) for one in row]) if known_one else 'unknown'
+                                 for row, known_one in zip(spacing, known)]
+    return extent_df
+
+
+def ExtentPercentile(extent_df, percentiles=percentile_list):
+    ''' rows: (SpacingGroup, Axis), 'all' is the whole cohort; columns: n_case and the percentiles of required_* '''
+    row_list = []
+    for group, group_df in [('all', extent_df)] + list(extent_df.groupby('SpacingGroup')):
+        value = np.percentile(group_df[['required_' + name for name in axis_name]].values, percentiles, axis=0)
+        for index, name in enumerate(axis_name):
+            row = {'SpacingGroup': group, 'Axis': name, 'n_case': len(group_df)}
+            row.update({'p{}'.format(one): value[p_index, index] for p_index, one in enumerate(percentiles)})
+            row_list.append(row)
+    return pd.DataFrame(row_list).set_index(['SpacingGroup', 'Axis'])
+
+
+def RecommendCropShape(required, coverage=0.95, multiple=(1, 1, 1)):
+    '''
+    The crop shape of the smallest volume such that at least coverage of the lesions fit in it along all the axes.
+    required: (n_case, 3) from RequiredShape; the candidates of each axis are rounded up to multiple.
+    Returns (crop_shape, covered fraction).
+    '''
+    required = np.asarray(required, dtype=np.int64)
+    multiple = np.asarray(multiple, dtype=np.int64)
+    rounded = -(-required // multiple) * multiple
+    n_case = len(rounded)
+    n_cover = int(np.ceil(coverage * n_case))
+    assert 0 < n_cover <= n_case
+
+    candidate_0, candidate_1 = np.unique(rounded[:, 0]), np.unique(rounded[:, 1])
+    fit_1 = rounded[:, 1:2] <= candidate_1[np.newaxis]                      # (n_case, n_1)
+    best_shape, best_volume = None, np.inf
+    for size_0 in candidate_0:
+        fit = fit_1 & (rounded[:, 0:1] <= size_0)
+        # the n_cover-th smallest slice size among the lesions that fit in (size_0, size_1), for every size_1
+        size_2 = np.sort(np.where(fit, rounded[:, 2:3], np.iinfo(np.int64).max), axis=0)[n_cover - 1]
+        valid = fit.sum(axis=0) >= n_cover
+        if not valid.any(): continue
+        volume = np.where(valid, size_0 * candidate_1 * size_2.astype(float), np.inf)
+        index = int(np.argmin(volume))
+        if volume[index] < best_volume:
+            best_volume = volume[index]
+            best_shape = (int(size_0), int(candidate_1[index]), int(size_2[index]))
+
+    covered = np.mean(np.all(rounded <= np.asarray(best_shape)[np.newaxis], axis=1))
+    return best_shape, float(covered)
+
+
+def AnalyzeExtent(data_folder, save_folder, roi_name='roi3D.nii', coverage=0.95, multiple=(1, 1, 1), n_workers=8):
+    '''
+    Writes lesion_extent.csv (per case), extent_percentile.csv (per spacing group and axis) and
+    crop_recommendation.csv (per spacing group) to save_folder. Returns the crop shape of the whole cohort.
+    '''
+    extent_df = ExtentTable(data_folder, os.path.join(save_folder, 'roi_geometry.csv'), roi_name=roi_name,
+                            n_workers=n_workers)
+    percentile_df = ExtentPercentile(extent_df)
+    extent_df.to_csv(os.path.join(save_folder, 'lesion_extent.csv'))
+    percentile_df.to_csv(os.path.join(save_folder, 'extent_percentile.csv'))
+
+    row_list = []
+    for group, group_df in [('all', extent_df)] + list(extent_df.groupby('SpacingGroup')):
+        crop_shape, covered = RecommendCropShape(group_df[['required_' + name for name in axis_name]].values,
+                                                 coverage=coverage, multiple=multiple)
+        row_list.append({'SpacingGroup': group, 'n_case': len(group_df), 'crop_shape': crop_shape,
+                         'covered': covered, 'voxels': int(np.prod(crop_shape))})
+    recommend_df = pd.DataFrame(row_list).set_index('SpacingGroup')
+    recommend_df.to_csv(os.path.join(save_folder, 'crop_recommendation.csv'))
+
+    print(percentile_df.loc['all'])
+    print(recommend_df)
+    return recommend_df.loc['all', 'crop_shape']
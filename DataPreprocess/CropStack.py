@@ -0,0 +1,47 @@
+'''
+Crop all co-registered modalities around the same center into one (channel, slice, height, width) array.
+'''
+import numpy as np
+
+
+def BlockSlice(image_shape, center_point, crop_shape, is_shift=True):
+    '''
+    The source and destination slices of a crop_shape block around center_point.
+    With is_shift, the block is moved back inside the image like ExtractBlock(is_shift=True); only the axes that are
+    smaller than crop_shape are padded.
+    '''
+    source_slice, target_slice = [], []
+    for size, center, crop in zip(image_shape, center_point, crop_shape):
+        start = int(center) - crop // 2
+        if is_shift and size >= crop:
+            start = min(max(start, 0), size - crop)
+        source_start, source_end = max(start, 0), min(start + crop, size)
+        source_slice.append(slice(source_start, source_end))
+        target_slice.append(slice(source_start - start, source_end - start))
+    return tuple(source_slice), tuple(target_slice)
+
+
+def CropStack(data_list, center_point, crop_shape=(100, 100, 50), n_image=None, n_extra=0, is_shift=True):
+    '''
+    data_list: (height, width, slice) volumes, center_point: (y, x, z), crop_shape: (height, width, slice).
+    The first n_image channels are z-normalized in place, the others (roi) are copied as they are.
+    n_extra empty channels are appended, e.g. for the attention map.
+    return: float32 (len(data_list) + n_extra, slice, height, width)
+    '''
+    if n_image is None:
+        n_image = len(data_list)
+    source_slice, target_slice = BlockSlice(np.shape(data_list[0]), center_point, crop_shape, is_shift=is_shift)
+    # the stack is (channel, slice, height, width), the source is (height, width, slice)
+    target_slice = (target_slice[2], target_slice[0], target_slice[1])
+
+    stack = np.zeros((len(data_list) + n_extra, crop_shape[2], crop_shape[0], crop_shape[1]), dtype=np.float32)
+    for index, data in enumerate(data_list):
+        assert np.shape(data) == np.shape(data_list[0]), 'data_list must be co-registered'
+        stack[index][target_slice] = data[source_slice].transpose((2, 0, 1))
+        if index < n_image:
+            channel = stack[index]
+            channel -= channel.mean()
+            std = channel.std()
+            if std > 0:
+                channel /= std
+    return stack
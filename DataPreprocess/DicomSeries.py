@@ -0,0 +1,38 @@
+'''
+Read a DICOM series (one series per folder) into one sitk Image without a NIfTI conversion step.
+The slice files are read on a thread pool, each once, and sorted once by their position along the slice normal.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def _ReadSlice(file_path):
+    # the rescale slope / intercept are applied by the reader
+    image = sitk.ReadImage(file_path, sitk.sitkFloat32)
+    return image.GetOrigin(), image.GetSpacing(), image.GetDirection(), sitk.GetArrayFromImage(image)
+
+
+def ReadSeries(series_folder, n_workers=8):
+    file_list = [os.path.join(series_folder, one) for one in sorted(os.listdir(series_folder))
+                 if os.path.isfile(os.path.join(series_folder, one))]
+    assert len(file_list) > 0, 'no slice in {}'.format(series_folder)
+    with ThreadPoolExecutor(n_workers) as executor:
+        slice_list = list(executor.map(_ReadSlice, file_list))
+
+    direction = np.array(slice_list[0][2]).reshape(3, 3)
+    normal = np.cross(direction[:, 0], direction[:, 1])
+    position = np.array([one[0] for one in slice_list]) @ normal
+    order = np.argsort(position)
+
+    data = np.concatenate([slice_list[index][3].reshape((-1, ) + slice_list[index][3].shape[-2:])
+                           for index in order], axis=0)
+    image = sitk.GetImageFromArray(data)
+    spacing = slice_list[order[0]][1]
+    slice_spacing = float(np.median(np.diff(position[order]))) if len(order) > 1 else spacing[2]
+    image.SetSpacing((spacing[0], spacing[1], slice_spacing))
+    image.SetOrigin(slice_list[order[0]][0])
+    image.SetDirection(tuple(np.stack([direction[:, 0], direction[:, 1], normal], axis=1).flatten()))
+    return image
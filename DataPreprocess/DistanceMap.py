@@ -46,31 +46,97 @@ def IntraSliceFilter(attention, diff_value, kernel_size=(1, 3, 3)):
 
     return new_attention
 
-base_rate = 0.1
-resolution = (1.5, 1.0, 1.0)
-slice_rate = resolution[0] / resolution[2] * base_rate
-for case in os.listdir(r'V:\yhzhang\BreastNpy\Roi'):
-    try:
-        data = np.load(os.path.join(r'V:\yhzhang\BreastNpy\Roi', case))
-        new_data = InterSliceFilter(data, slice_rate)
-        new_data = IntraSliceFilter(new_data, base_rate)
-        # np.save(os.path.join(r'V:\yhzhang\BreastNpy\RoiDilated', case), new_data)
-        flatten_data = FlattenImages(data)
-        flatten_roi = FlattenImages(new_data)
-        plt.figure(figsize=(16, 8))
-        plt.subplot(121)
-        plt.axis('off')
-        plt.imshow(flatten_data, cmap='gray')
-        plt.subplot(122)
-        plt.axis('off')
-        plt.imshow(flatten_roi, cmap='gray')
-        plt.show()
-        # plt.savefig(os.path.join(r'V:\yhzhang\BreastNpy\ImageDilated', case.split('.npy')[0]))
-        # plt.close()
-    except Exception as e:
-        print(e)
-        print(case)
-
-
-
-# for case in os.listdir()
\ No newline at end of file
+
+def AttentionMapLoop(roi, base_rate=0.1, resolution=(1.5, 1.0, 1.0)):
+    ''' the original InterSliceFilter + IntraSliceFilter, kept as reference for CheckAttentionMap '''
+    slice_rate = resolution[0] / resolution[2] * base_rate
+    new_data = InterSliceFilter(roi, slice_rate)
+    new_data = IntraSliceFilter(new_data, base_rate)
+    return new_data
+
+
+def AttentionMap(roi, base_rate=0.1, resolution=(1.5, 1.0, 1.0)):
+    '''
+    roi: (slice, height, width), resolution in the same order.
+    The map of AttentionMapLoop, computed on the bounding box of the roi only. The loops spread less than 1 / rate
+    voxels from the roi and each median filter grows the support by at most one voxel, so the map is zero outside the
+    box and the same inside it. No distance transform gives this map: the in-plane loop lowers a voxel next to a
+    higher one to that value - base_rate, which a chessboard distance of the inter-slice map misses by up to 0.05.
+    '''
+    roi = np.asarray(roi)
+    attention = np.zeros_like(roi)
+    index = np.nonzero(roi)
+    if len(index[0]) == 0:
+        return attention
+
+    slice_rate = resolution[0] / resolution[2] * base_rate
+    margin = [int(np.ceil(1 / slice_rate)) + 3, int(np.ceil(1 / base_rate)) + 3, int(np.ceil(1 / base_rate)) + 3]
+    box = tuple(slice(max(int(one.min()) - extra, 0), min(int(one.max()) + extra + 1, size))
+                for one, extra, size in zip(index, margin, roi.shape))
+    attention[box] = AttentionMapLoop(roi[box], base_rate=base_rate, resolution=resolution)
+    return attention
+
+
+def SyntheticRoi(shape=(50, 100, 100)):
+    ''' (name, roi) of the shapes the crops contain: ellipsoids, a point, two lesions, a roi on the border, empty '''
+    z, y, x = np.mgrid[:shape[0], :shape[1], :shape[2]]
+    center = [one // 2 for one in shape]
+
+    def Ellipsoid(center, radius):
+        return ((z - center[0]) / radius[0]) ** 2 + ((y - center[1]) / radius[1]) ** 2 + \
+               ((x - center[2]) / radius[2]) ** 2 <= 1
+
+    point = np.zeros(shape, dtype=bool)
+    point[tuple(center)] = True
+    roi_list = [('ellipsoid', Ellipsoid(center, (6, 15, 20))),
+                ('oblique', Ellipsoid(center, (4, 25, 8)) & (np.abs(y - x) < 12)),
+                ('point', point),
+                ('two', Ellipsoid((15, 30, 30), (3, 6, 6)) | Ellipsoid((35, 70, 65), (5, 10, 8))),
+                ('border', Ellipsoid((1, 2, 50), (4, 10, 10))),
+                ('empty', np.zeros(shape, dtype=bool))]
+    return [(name, roi.astype(np.float32)) for name, roi in roi_list]
+
+
+def CheckAttentionMap(roi_folder=None, atol=1e-6):
+    '''
+    AttentionMap against the loops on the whole volume, on synthetic rois or on the npy rois of roi_folder.
+    '''
+    if roi_folder is None:
+        roi_list = SyntheticRoi()
+    else:
+        roi_list = [(case, np.load(os.path.join(roi_folder, case))) for case in sorted(os.listdir(roi_folder))]
+    for name, roi in roi_list:
+        loop_map = AttentionMapLoop(roi)
+        new_map = AttentionMap(roi)
+        max_diff = np.abs(loop_map - new_map).max()
+        print('{}: max {:.2e}'.format(name, max_diff))
+        assert new_map.shape == loop_map.shape and max_diff <= atol, name
+# CheckAttentionMap()
+
+
+def ShowDilated(roi_folder=r'V:\yhzhang\BreastNpy\Roi'):
+    for case in os.listdir(roi_folder):
+        try:
+            data = np.load(os.path.join(roi_folder, case))
+            new_data = AttentionMap(data)
+            # np.save(os.path.join(r'V:\yhzhang\BreastNpy\RoiDilated', case), new_data)
+            flatten_data = FlattenImages(data)
+            flatten_roi = FlattenImages(new_data)
+            plt.figure(figsize=(16, 8))
+            plt.subplot(121)
+            plt.axis('off')
+            plt.imshow(flatten_data, cmap='gray')
+            plt.subplot(122)
+            plt.axis('off')
+            plt.imshow(flatten_roi, cmap='gray')
+            plt.show()
+            # plt.savefig(os.path.join(r'V:\yhzhang\BreastNpy\ImageDilated', case.split('.npy')[0]))
+            # plt.close()
+        except Exception as e:
+            print(e)
+            print(case)
+# ShowDilated()
+
+
+
+# for case in os.listdir()
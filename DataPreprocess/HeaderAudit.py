@@ -0,0 +1,77 @@
+'''
+Audit the geometry of a NIfTI cohort from the image headers only (no voxel data is decompressed),
+with a thread pool over the files.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+geometry_key = ['size', 'spacing', 'origin', 'direction']
+
+
+def ReadHeader(file_path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_path)
+    reader.ReadImageInformation()
+    return {'size': reader.GetSize(),
+            'spacing': reader.GetSpacing(),
+            'origin': reader.GetOrigin(),
+            'direction': reader.GetDirection(),
+            'dtype': sitk.GetPixelIDValueAsString(reader.GetPixelID())}
+
+
+def _ReadOne(case_file):
+    case, data_type, file_path = case_file
+    row = {'CaseName': case, 'Type': data_type}
+    try:
+        row.update(ReadHeader(file_path))
+        row['Error'] = ''
+    except Exception as e:
+        row['Error'] = 'missing' if not os.path.exists(file_path) else str(e).strip().split('\n')[-1]
+    return row
+
+
+def CompareHeader(reference, header, atol=1e-4):
+    ''' the geometry keys of header that differ from reference '''
+    mismatch = []
+    for key in geometry_key:
+        if len(reference[key]) != len(header[key]) or not np.allclose(reference[key], header[key], atol=atol):
+            mismatch.append(key)
+    return mismatch
+
+
+def AuditCohort(data_folder, type_list, save_path=None, n_workers=16, atol=1e-4):
+    '''
+    One row per case and type with size, spacing, origin, direction and dtype. The geometry of every type is compared
+    with type_list[0] of the same case, the differing keys are listed in Mismatch.
+    '''
+    case_file_list = [(case, data_type, os.path.join(data_folder, case, data_type))
+                      for case in sorted(os.listdir(data_folder)) if os.path.isdir(os.path.join(data_folder, case))
+                      for data_type in type_list]
+    with ThreadPoolExecutor(n_workers) as executor:
+        row_list = list(executor.map(_ReadOne, case_file_list))
+
+    reference = {}
+    for row in row_list:
+        if row['Type'] == type_list[0] and not row['Error']:
+            reference[row['CaseName']] = row
+    for row in row_list:
+        if row['Error']:
+            row['Mismatch'] = ''
+        elif row['CaseName'] not in reference:
+            row['Mismatch'] = 'no reference'
+        else:
+            row['Mismatch'] = ';'.join(CompareHeader(reference[row['CaseName']], row, atol=atol))
+
+    audit_df = pd.DataFrame(row_list, columns=['CaseName', 'Type', 'dtype'] + geometry_key + ['Mismatch', 'Error'])
+    if save_path:
+        audit_df.to_csv(save_path, index=False)
+
+    flag_df = audit_df[(audit_df['Mismatch'] != '') | (audit_df['Error'] != '')]
+    for _, row in flag_df.iterrows():
+        print('{} {}: {}'.format(row['CaseName'], row['Type'], row['Mismatch'] or row['Error']))
+    print('{} cases, {} files, {} flagged'.format(audit_df['CaseName'].nunique(), len(audit_df), len(flag_df)))
+    return audit_df
@@ -0,0 +1,40 @@
+'''
+One-time mirror of the nii.gz cohort to uncompressed npy (the same array as MeDIT LoadImage returns).
+The mirror is opened as memmap, so a crop only reads the pages of its block instead of decompressing the whole volume.
+'''
+import os
+import numpy as np
+
+from DataPreprocess.CropCache import SaveNpy
+
+
+def MirrorPath(mirror_folder, case, data_type):
+    return os.path.join(mirror_folder, case, '{}.npy'.format(data_type.split('.nii')[0]))
+
+
+def MirrorCase(case, data_folder, mirror_folder, type_list):
+    ''' mirror the types of one case whose mirror is missing or older than the nii file '''
+    from MeDIT.SaveAndLoad import LoadImage
+    if not os.path.exists(os.path.join(mirror_folder, case)):
+        os.makedirs(os.path.join(mirror_folder, case), exist_ok=True)
+    for data_type in type_list:
+        source_path = os.path.join(data_folder, case, data_type)
+        mirror_path = MirrorPath(mirror_folder, case, data_type)
+        if os.path.exists(mirror_path) and os.path.getmtime(mirror_path) >= os.path.getmtime(source_path):
+            continue
+        _, data, _ = LoadImage(source_path, is_show_info=False)
+        SaveNpy(mirror_path, np.ascontiguousarray(data))
+
+
+def BuildMirror(data_folder, mirror_folder, type_list, n_workers=8):
+    from DataPreprocess.CasePool import RunCasePool
+    if not os.path.exists(mirror_folder):
+        os.makedirs(mirror_folder)
+    case_list = [case for case in sorted(os.listdir(data_folder)) if os.path.isdir(os.path.join(data_folder, case))]
+    return RunCasePool(case_list, MirrorCase, os.path.join(mirror_folder, 'mirror_manifest.csv'), n_workers=n_workers,
+                       is_resume=False, data_folder=data_folder, mirror_folder=mirror_folder, type_list=type_list)
+
+
+def LoadMirror(mirror_folder, case, data_type):
+    ''' memmap of the mirrored volume, slicing it reads only the requested block '''
+    return np.load(MirrorPath(mirror_folder, case, data_type), mmap_mode='r')
@@ -0,0 +1,106 @@
+'''
+Pre-flight check of the npy dataset (data_root/{type}/{case}.npy) before training. Only the npy headers are read,
+with a thread pool over the files, so a missing, truncated or wrong-shape file is found before a DataLoader worker
+crashes on it. The label coverage is checked against label.csv and the split csv files.
+'''
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def ReadNpyHeader(file_path):
+    ''' shape, dtype and whether the file holds all the bytes the header announces '''
+    with open(file_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    expected = offset + int(np.prod(shape)) * dtype.itemsize
+    return {'shape': tuple(shape), 'dtype': str(dtype), 'is_complete': dtype.hasobject or
+            os.path.getsize(file_path) >= expected}
+
+
+def _ScanOne(case_file):
+    case, data_type, file_path = case_file
+    row = {'CaseName': case, 'Type': data_type, 'shape': None, 'dtype': ''}
+    try:
+        row.update(ReadNpyHeader(file_path))
+        row['Error'] = '' if row.pop('is_complete') else 'truncated'
+    except Exception as e:
+        row['Error'] = 'missing' if not os.path.exists(file_path) else 'unreadable: {}'.format(e)
+    return row
+
+
+def ScanNpy(data_root, type_list, label_name='label.csv', split_list=('alltrain_label.csv', 'test.csv'),
+            input_shape=None, n_workers=32, save_path=None):
+    '''
+    type_list: the folders of data_root, e.g. ['Adc', 'Eser', 'T2', 'RoiDilated'].
+    split_list: the split files the caller reads (e.g. only alltrain_label.csv for training), the missing ones are
+        skipped. Only their cases are scanned, label.csv only gives their labels; with no split file, every case of
+        label.csv is scanned.
+    The shape and dtype of each file are compared with the most common ones of the cohort, input_shape (the last axes)
+    must fit in the shape. The npys of a case without a row in label.csv are printed as warnings, they are never read.
+    Returns (scan_df, problem_list); scan_df has one row per case and type.
+    '''
+    problem_list = []
+    label_df = pd.read_csv(os.path.join(data_root, label_name), index_col='CaseName')
+    label_df.index = label_df.index.astype(str)
+    label_case = set(label_df.index)
+    case_set, n_split = set(), 0
+    for split_name in split_list or ():
+        split_path = os.path.join(data_root, split_name)
+        if not os.path.exists(split_path): continue
+        split_case = set(pd.read_csv(split_path, index_col='CaseName').index.astype(str))
+        for case in sorted(split_case - label_case):
+            problem_list.append('{}: in {} but not in {}'.format(case, split_name, label_name))
+        case_set |= split_case
+        n_split += 1
+    if n_split == 0:
+        case_set = set(label_case)
+    for case in sorted(case_set & set(label_df.index[label_df['Label'].isna()])):
+        problem_list.append('{}: no label in {}'.format(case, label_name))
+    for data_type in type_list:
+        type_folder = os.path.join(data_root, data_type)
+        if not os.path.isdir(type_folder): continue
+        npy_case = set([one[:-len('.npy')] for one in os.listdir(type_folder) if one.endswith('.npy')])
+        for case in sorted(npy_case - label_case):
+            print('warning: {} {}: npy without a row in {}'.format(case, data_type, label_name))
+
+    case_file_list = [(case, data_type, os.path.join(data_root, data_type, '{}.npy'.format(case)))
+                      for case in sorted(case_set) for data_type in type_list]
+    with ThreadPoolExecutor(n_workers) as executor:
+        row_list = list(executor.map(_ScanOne, case_file_list))
+    scan_df = pd.DataFrame(row_list, columns=['CaseName', 'Type', 'shape', 'dtype', 'Error'])
+
+    valid_df = scan_df[scan_df['Error'] == '']
+    if len(valid_df):
+        common_shape = Counter(valid_df['shape']).most_common(1)[0][0]
+        common_dtype = Counter(valid_df['dtype']).most_common(1)[0][0]
+        for index, row in valid_df.iterrows():
+            if row['shape'] != common_shape:
+                scan_df.loc[index, 'Error'] = 'shape {} != {}'.format(row['shape'], common_shape)
+            elif row['dtype'] != common_dtype:
+                scan_df.loc[index, 'Error'] = 'dtype {} != {}'.format(row['dtype'], common_dtype)
+            elif input_shape is not None and (len(row['shape']) < len(input_shape) or
+                                              np.any(np.less(row['shape'][-len(input_shape):], input_shape))):
+                scan_df.loc[index, 'Error'] = 'shape {} smaller than input {}'.format(row['shape'], input_shape)
+    for _, row in scan_df[scan_df['Error'] != ''].iterrows():
+        problem_list.append('{} {}: {}'.format(row['CaseName'], row['Type'], row['Error']))
+
+    if save_path:
+        scan_df.to_csv(save_path, index=False)
+    print('{} cases, {} files, {} problems'.format(len(case_set), len(scan_df), len(problem_list)))
+    return scan_df, problem_list
+
+
+def CheckNpy(data_root, type_list, **kwargs):
+    ''' ScanNpy, raises ValueError listing the problems if there is any '''
+    scan_df, problem_list = ScanNpy(data_root, type_list, **kwargs)
+    if problem_list:
+        raise ValueError('{} problems in {}:\n{}'.format(len(problem_list), data_root, '\n'.join(problem_list)))
+    return scan_df
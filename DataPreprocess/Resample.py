@@ -0,0 +1,106 @@
+'''
+Resample every modality and the roi of a case onto one grid of target spacing before cropping, so a crop of
+crop_shape voxels and the attention map cover the same physical size in every case.
+target_spacing is (x, y, z) in mm, the order of the nii header. The grid keeps the origin and the direction of the
+first type of the case and covers its physical extent; the other types are resampled onto the same grid, so all the
+arrays of a case have the same shape. The images are interpolated linearly, the roi (the last type) with the nearest
+neighbour.
+'''
+import os
+import socket
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def TargetGrid(reference, target_spacing):
+    ''' reference: a sitk Image or ImageFileReader after ReadImageInformation '''
+    size = [max(1, int(round(one_size * one_spacing / one_target))) for one_size, one_spacing, one_target
+            in zip(reference.GetSize(), reference.GetSpacing(), target_spacing)]
+    return {'size': size, 'spacing': [float(one) for one in target_spacing], 'origin': reference.GetOrigin(),
+            'direction': reference.GetDirection()}
+
+
+def ResampleImage(image, grid, is_roi=False):
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(grid['size'])
+    resampler.SetOutputSpacing(grid['spacing'])
+    resampler.SetOutputOrigin(grid['origin'])
+    resampler.SetOutputDirection(grid['direction'])
+    resampler.SetDefaultPixelValue(0)
+    if is_roi:
+        resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    else:
+        resampler.SetInterpolator(sitk.sitkLinear)
+        resampler.SetOutputPixelType(sitk.sitkFloat32)
+    return resampler.Execute(image)
+
+
+def ImageToArray(image):
+    ''' (height, width, slice), the same order as MeDIT LoadImage '''
+    return np.transpose(sitk.GetArrayFromImage(image), (1, 2, 0))
+
+
+def ResampleImageList(image_list, target_spacing):
+    ''' image_list[-1] must be roi; returns the resampled arrays (height, width, slice) '''
+    grid = TargetGrid(image_list[0], target_spacing)
+    return [ImageToArray(ResampleImage(image, grid, is_roi=index == len(image_list) - 1))
+            for index, image in enumerate(image_list)]
+
+
+def ResampleCase(case, data_folder, save_folder, type_list, target_spacing, cache_folder=None):
+    '''
+    data_folder/case/type -> save_folder/case/type (same file name), type_list[-1] must be roi.
+    Each output is keyed by the hash of its source, of the grid reference (type_list[0]) and target_spacing
+    (DataPreprocess/CropCache), the unchanged outputs are not resampled again. The records are kept in
+    cache_folder/{case}.json (save_folder + '_cache' by default), out of save_folder/case: it is the data_folder of
+    the crop, whose queue compares the mtimes of the files of the case folder (CaseQueue.SourceStamp).
+    '''
+    from DataPreprocess.CropCache import CaseCache
+    case_folder = os.path.join(data_folder, case)
+    if not os.path.exists(os.path.join(save_folder, case)):
+        os.makedirs(os.path.join(save_folder, case), exist_ok=True)
+    if cache_folder is None:
+        cache_folder = os.path.normpath(save_folder) + '_cache'
+    cache = CaseCache(cache_folder, case)
+
+    reference_path = os.path.join(case_folder, type_list[0])
+    key_list = [cache.Key([os.path.join(case_folder, data_type), reference_path], target_spacing=list(target_spacing))
+                for data_type in type_list]
+    output_list = [os.path.join(save_folder, case, data_type) for data_type in type_list]
+    stale_list = [index for index in range(len(type_list))
+                  if not cache.IsValid(type_list[index], key_list[index], output_list[index])]
+    if len(stale_list) == 0:
+        cache.Save()
+        return
+
+    # the grid only needs the header of the reference
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(reference_path)
+    reader.ReadImageInformation()
+    grid = TargetGrid(reader, target_spacing)
+    for index in stale_list:
+        image = sitk.ReadImage(os.path.join(case_folder, type_list[index]))
+        resampled = ResampleImage(image, grid, is_roi=index == len(type_list) - 1)
+        # the extension of the temp file selects the same writer as the output
+        temp_path = os.path.join(save_folder, case, 'tmp.{}.{}.{}'.format(socket.gethostname(), os.getpid(),
+                                                                          type_list[index]))
+        sitk.WriteImage(resampled, temp_path)
+        os.replace(temp_path, output_list[index])
+        cache.Update(type_list[index], key_list[index])
+    cache.Save()
+
+
+def ResampleCohort(data_folder, save_folder, type_list, target_spacing, n_workers=8):
+    from DataPreprocess.CasePool import RunCasePool
+    if not os.path.exists(save_folder):
+        os.makedirs(save_folder, exist_ok=True)
+    case_list = [case for case in sorted(os.listdir(data_folder)) if os.path.isdir(os.path.join(data_folder, case))]
+    return RunCasePool(case_list, ResampleCase, os.path.join(save_folder, 'resample_manifest.csv'),
+                       n_workers=n_workers, is_resume=False, data_folder=data_folder, save_folder=save_folder,
+                       type_list=type_list, target_spacing=target_spacing)
+
+
+def AttentionResolution(target_spacing):
+    ''' the resolution of DistanceMap.AttentionMap, which works on the crops (slice, height, width) '''
+    return (target_spacing[2], target_spacing[1], target_spacing[0])
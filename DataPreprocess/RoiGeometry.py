@@ -0,0 +1,105 @@
+'''
+ROI geometry (center, centroid, bounding box, extent, volume) from the axis projections of one scan of the roi,
+and a cohort index of it, so the crop and visualization paths do not rescan the roi volumes.
+All values are per array axis, e.g. (height, width, slice) for the nii arrays.
+'''
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from DataPreprocess.CropCache import AtomicPath
+
+axis_name = ['0', '1', '2']
+
+
+def RoiGeometry(roi):
+    '''
+    center: median of the occupied indices of each axis, the same as int(np.median(np.unique(np.nonzero(roi)[axis]))).
+    '''
+    mask = np.squeeze(roi) > 0
+    assert mask.ndim == 3 and mask.any(), 'roi must be a non-empty 3D volume'
+
+    # one scan of the volume, the other projections are taken from the 2D one
+    count_01 = mask.sum(axis=2)
+    count_list = [count_01.sum(axis=1), count_01.sum(axis=0), mask.sum(axis=(0, 1))]
+
+    geometry = {'volume': int(count_01.sum())}
+    for name, count in zip(axis_name, count_list):
+        occupied = np.flatnonzero(count)
+        geometry['center_' + name] = int(np.median(occupied))
+        geometry['centroid_' + name] = float(np.dot(count, np.arange(count.size)) / geometry['volume'])
+        geometry['min_' + name] = int(occupied[0])
+        geometry['max_' + name] = int(occupied[-1])
+        geometry['extent_' + name] = int(occupied[-1] - occupied[0])
+    return geometry
+
+
+def GeometryCenter(geometry):
+    return tuple(int(geometry['center_' + name]) for name in axis_name)
+
+
+def GeometryExtent(geometry):
+    return tuple(int(geometry['extent_' + name]) for name in axis_name)
+
+
+def _CaseGeometry(roi_path):
+    from MeDIT.SaveAndLoad import LoadImage
+    stat = os.stat(roi_path)
+    try:
+        _, roi, _ = LoadImage(roi_path, is_show_info=False)
+        geometry = RoiGeometry(roi)
+        geometry['shape'] = 'x'.join([str(one) for one in roi.shape])
+    except Exception as e:
+        print('{}: {}'.format(roi_path, e))
+        return None
+    # the integer mtime_ns survives the csv round trip, a float mtime does not always
+    geometry['size'], geometry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+    return geometry
+
+
+def BuildGeometryIndex(data_folder, index_path, roi_name='roi3D.nii', n_workers=8):
+    '''
+    data_folder/{case}/roi_name -> index_path (CaseName, center_*, centroid_*, min_*, max_*, extent_*, volume, shape).
+    The cases whose roi file did not change (size, mtime_ns) are not loaded again.
+    '''
+    index_df = LoadGeometryIndex(index_path) if os.path.exists(index_path) else pd.DataFrame()
+    if 'mtime_ns' not in index_df.columns:
+        # an index of the float mtime is scanned again once
+        index_df = pd.DataFrame()
+
+    case_list, todo_list = [], []
+    for case in sorted(os.listdir(data_folder)):
+        roi_path = os.path.join(data_folder, case, roi_name)
+        if not os.path.isfile(roi_path): continue
+        case_list.append(case)
+        stat = os.stat(roi_path)
+        if case in index_df.index and index_df.loc[case, 'size'] == stat.st_size and \
+                index_df.loc[case, 'mtime_ns'] == stat.st_mtime_ns:
+            continue
+        todo_list.append(case)
+
+    with Pool(n_workers) as pool:
+        geometry_list = pool.map(_CaseGeometry, [os.path.join(data_folder, case, roi_name) for case in todo_list])
+    new_df = pd.DataFrame([one for one in geometry_list if one is not None],
+                          index=pd.Index([case for case, one in zip(todo_list, geometry_list) if one is not None],
+                                         name='CaseName'))
+
+    index_df = pd.concat([index_df.drop(index=[case for case in new_df.index if case in index_df.index]), new_df])
+    index_df = index_df.loc[[case for case in case_list if case in index_df.index]]
+    index_df.index.name = 'CaseName'
+    # several machines may build the index of a shared cohort at the same time (DataPreprocess/CaseQueue)
+    with AtomicPath(index_path) as temp_path:
+        index_df.to_csv(temp_path)
+    print('{} cases, {} scanned'.format(len(index_df), len(new_df)))
+    return index_df
+
+
+def LoadGeometryIndex(index_path):
+    return pd.read_csv(index_path, index_col='CaseName')
+
+
+def CenterDict(geometry_df):
+    ''' {case: center} of a geometry index, parsed once by the driver and passed to the case functions '''
+    return {str(case): GeometryCenter(row) for case, row in geometry_df.iterrows()}
@@ -0,0 +1,69 @@
+'''
+Write-behind stage for the preprocessing outputs: npy files and figures are written by background threads while the
+next case is computed. At most max_pending writes are held in memory, Submit blocks when the queue is full.
+All files are written to a temp file and renamed, a partial file never appears in the output folders.
+'''
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from DataPreprocess.CropCache import SaveNpy, AtomicPath
+
+
+def SaveFigure(figure, output_path, **kwargs):
+    ''' figure is a matplotlib.figure.Figure (not pyplot, which is not thread-safe) '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    FigureCanvasAgg(figure)
+    with AtomicPath(output_path) as temp_path:
+        figure.savefig(temp_path, format=os.path.splitext(output_path)[1][1:] or 'png', **kwargs)
+
+
+class WriteBehind():
+    def __init__(self, n_workers=2, max_pending=8):
+        self._executor = ThreadPoolExecutor(n_workers)
+        self._slot = threading.BoundedSemaphore(max_pending)
+        self._error_list = []
+        self.wait_time = 0.
+        self.count = 0
+
+    def _Run(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self._error_list.append(e)
+        finally:
+            self._slot.release()
+
+    def Submit(self, func, *args, **kwargs):
+        if self._error_list:
+            raise self._error_list[0]
+        start = time.time()
+        self._slot.acquire()
+        self.wait_time += time.time() - start
+        self.count += 1
+        self._executor.submit(self._Run, func, args, kwargs)
+
+    def SaveNpy(self, output_path, data):
+        self.Submit(SaveNpy, output_path, data)
+
+    def SaveFigure(self, figure, output_path, **kwargs):
+        self.Submit(SaveFigure, figure, output_path, **kwargs)
+
+    def Close(self):
+        ''' wait for all the writes, the first error of the writers is raised here '''
+        self._executor.shutdown(wait=True)
+        if self._error_list:
+            raise self._error_list[0]
+
+    def Report(self):
+        return 'writes {}, blocked {:.1f}s on a full queue'.format(self.count, self.wait_time)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.Close()
+        else:
+            self._executor.shutdown(wait=True)
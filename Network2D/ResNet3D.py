@@ -2,10 +2,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import contextlib
 
 ''' https://github.com/Tushar-N/pytorch-resnet3d/blob/master/models/resnet.py '''
 
 
+def _ProfileRange(name):
+    ''' record_function while a torch.profiler runs (Process/Profiler), a free no-op context otherwise '''
+    if torch.autograd.profiler._is_profiler_enabled:
+        return torch.profiler.record_function(name)
+    return contextlib.nullcontext()
+
 
 class ChannelAttention(nn.Module):
     def __init__(self, in_planes, ratio=8):
@@ -85,14 +92,15 @@ class Bottleneck(nn.Module):
         out = self.conv3(out)
         out = self.bn3(out)
 
-        shape = out.shape[2:]
-        dis_map_resize = F.interpolate(dis_map, size=shape, mode='trilinear', align_corners=True)
+        with _ProfileRange('Bottleneck.attention'):
+            shape = out.shape[2:]
+            dis_map_resize = F.interpolate(dis_map, size=shape, mode='trilinear', align_corners=True)
 
-        out = self.ca(out) * out
-        out_fm = self.sa_fm(out) * out
-        out_dm = dis_map_resize * out
+            out = self.ca(out) * out
+            out_fm = self.sa_fm(out) * out
+            out_dm = dis_map_resize * out
 
-        out = self.conv1x1(torch.cat([out_fm, out_dm], dim=1))
+            out = self.conv1x1(torch.cat([out_fm, out_dm], dim=1))
 
         if self.downsample is not None:
             residual = self.downsample(feature_map)
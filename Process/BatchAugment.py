@@ -0,0 +1,191 @@
+'''
+Augmentation of a whole batch on the device, with the same param_config as MeDIT.Augment (keyed by the .name of the
+transforms). The inputs are (batch, channel, slice, height, width), every slice of a sample gets the same in-plane
+transform as in the per-sample augmentation.
+Geometric (Flip, Zoom, Rotate, Shift, Elastic): one sampling grid per sample, one grid_sample for the images and the
+dis_map together, so the roi attention map stays aligned with the images.
+Intensity (Bias, Noise, Contrast, Gamma): vectorized over the batch, on the images only.
+Parameter specs: ['uniform', low, high] or ['uniform', low, high, size], ['choice', option, ...].
+Elastic: ['elastic', probability, alpha, field_size], a white noise field of field_size x field_size is smoothed,
+resized to the image and scaled to a std of alpha (in the [-1, 1] grid coordinates).
+'''
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def _TransformName():
+    from MeDIT.Augment import RotateTransform, ShiftTransform, ZoomTransform, FlipTransform, BiasTransform, \
+        NoiseTransform, ContrastTransform, GammaTransform, ElasticTransform
+    return {RotateTransform.name: 'rotate', ShiftTransform.name: 'shift', ZoomTransform.name: 'zoom',
+            FlipTransform.name: 'flip', BiasTransform.name: 'bias', NoiseTransform.name: 'noise',
+            ContrastTransform.name: 'contrast', GammaTransform.name: 'gamma', ElasticTransform.name: 'elastic'}
+
+
+def SampleParam(spec, n, device):
+    ''' (n, ) or (n, size) float tensor drawn from a param_config spec '''
+    if spec[0] == 'uniform':
+        shape = (n, ) if len(spec) < 4 else (n, spec[3])
+        return torch.empty(shape, device=device).uniform_(float(spec[1]), float(spec[2]))
+    elif spec[0] == 'choice':
+        option = torch.tensor([float(one) for one in spec[1:]], device=device)
+        return option[torch.randint(len(option), (n, ), device=device)]
+    raise ValueError('unknown parameter spec: {}'.format(spec))
+
+
+def GaussianKernel(sigma, device):
+    radius = max(1, int(math.ceil(3 * sigma)))
+    x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=device)
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def SmoothField(noise, sigma):
+    ''' separable gaussian smoothing of (n, 2, size, size) '''
+    kernel = GaussianKernel(sigma, noise.device)
+    pad = len(kernel) // 2
+    field = F.conv2d(F.pad(noise.flatten(0, 1)[:, None], (pad, pad, 0, 0), mode='reflect'),
+                     kernel.view(1, 1, 1, -1))
+    field = F.conv2d(F.pad(field, (0, 0, pad, pad), mode='reflect'), kernel.view(1, 1, -1, 1))
+    return field.view(noise.shape)
+
+
+def ElasticField(n, field_size, alpha, output_size, device):
+    ''' (n, height, width, 2) displacement in grid coordinates '''
+    field = SmoothField(torch.randn(n, 2, field_size, field_size, device=device), field_size / 8)
+    field = field / field.flatten(1).std(dim=1).clamp_min(1e-6).view(n, 1, 1, 1) * alpha
+    field = F.interpolate(field, size=output_size, mode='bilinear', align_corners=False)
+    return field.permute(0, 2, 3, 1)
+
+
+class ElasticBank():
+    '''
+    n_field elastic fields precomputed on the device, with a margin for the offsets. A draw picks a random field, a
+    random offset and random flips (the flipped displacement component changes sign), so a sample costs a gather
+    instead of smoothing a new field. n_refresh fields are regenerated per draw, in turn, so the bank changes during
+    the run without a pause.
+    '''
+    def __init__(self, field_size, alpha, output_size, device, n_field=256, n_refresh=1):
+        self.field_size, self.alpha = field_size, alpha
+        self.output_size = tuple(output_size)
+        self.margin = [max(1, one // 8) for one in self.output_size]
+        self.bank_size = tuple(one + 2 * margin for one, margin in zip(self.output_size, self.margin))
+        self.n_refresh = min(n_refresh, n_field)
+        self.next_refresh = 0
+        self.bank = torch.cat([ElasticField(one, field_size, alpha, self.bank_size, device)
+                               for one in [64] * (n_field // 64) + [n_field % 64] if one > 0])
+
+    def Refresh(self):
+        if self.n_refresh == 0: return
+        index = (self.next_refresh + torch.arange(self.n_refresh)) % len(self.bank)
+        self.bank[index.to(self.bank.device)] = ElasticField(self.n_refresh, self.field_size, self.alpha,
+                                                             self.bank_size, self.bank.device)
+        self.next_refresh = int(index[-1] + 1) % len(self.bank)
+
+    def Draw(self, n):
+        device = self.bank.device
+        height, width = self.output_size
+        index = torch.randint(len(self.bank), (n, ), device=device)
+        offset_y = torch.randint(2 * self.margin[0] + 1, (n, 1), device=device)
+        offset_x = torch.randint(2 * self.margin[1] + 1, (n, 1), device=device)
+        flip = torch.rand(n, 2, device=device) < 0.5
+        row = torch.arange(height, device=device)
+        col = torch.arange(width, device=device)
+        row = offset_y + torch.where(flip[:, 1:], height - 1 - row, row)
+        col = offset_x + torch.where(flip[:, :1], width - 1 - col, col)
+        field = self.bank[index[:, None, None], row[:, :, None], col[:, None, :]]
+        sign = 1 - 2 * flip.float()                           # (x, y) components
+        self.Refresh()
+        return field * sign.view(n, 1, 1, 2)
+
+
+class BatchAugment():
+    '''
+    n_elastic_field > 0: the elastic fields are drawn from an ElasticBank of that size, n_refresh of them are
+    regenerated per batch. 0: a new field is smoothed for every sample.
+    '''
+    def __init__(self, param_config, transform_name=None, n_elastic_field=256, n_refresh=1):
+        transform_name = _TransformName() if transform_name is None else transform_name
+        self.param = {transform_name[key]: value for key, value in param_config.items()}
+        self.n_elastic_field = n_elastic_field
+        self.n_refresh = n_refresh
+        self.elastic_bank = None
+
+    def _Affine(self, n, device):
+        ''' (n, 2, 3), maps the output grid to the input grid, x is the width and y the height '''
+        scale_x, scale_y = torch.ones(n, device=device), torch.ones(n, device=device)
+        if 'flip' in self.param:
+            flip = SampleParam(self.param['flip']['horizontal_flip'], n, device)
+            scale_x = torch.where(flip > 0, -scale_x, scale_x)
+        if 'zoom' in self.param:
+            scale_x = scale_x / SampleParam(self.param['zoom']['horizontal_zoom'], n, device)
+            scale_y = scale_y / SampleParam(self.param['zoom']['vertical_zoom'], n, device)
+        angle = torch.zeros(n, device=device)
+        if 'rotate' in self.param:
+            angle = SampleParam(self.param['rotate']['theta'], n, device) * math.pi / 180
+        shift_x, shift_y = torch.zeros(n, device=device), torch.zeros(n, device=device)
+        if 'shift' in self.param:
+            shift_x = 2 * SampleParam(self.param['shift']['horizontal_shift'], n, device)
+            shift_y = 2 * SampleParam(self.param['shift']['vertical_shift'], n, device)
+
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        return torch.stack([torch.stack([cos * scale_x, -sin * scale_y, shift_x], dim=1),
+                            torch.stack([sin * scale_x, cos * scale_y, shift_y], dim=1)], dim=1)
+
+    def _Elastic(self, n, output_size, device):
+        _, probability, alpha, field_size = self.param['elastic']
+        if self.n_elastic_field > 0:
+            if self.elastic_bank is None or self.elastic_bank.output_size != tuple(output_size) or \
+                    self.elastic_bank.bank.device != device:
+                self.elastic_bank = ElasticBank(int(field_size), float(alpha), output_size, device,
+                                                n_field=self.n_elastic_field, n_refresh=self.n_refresh)
+            field = self.elastic_bank.Draw(n)
+        else:
+            field = ElasticField(n, int(field_size), float(alpha), output_size, device)
+        return field * (torch.rand(n, device=device) < probability).float().view(n, 1, 1, 1)
+
+    def Grid(self, n, output_size, device):
+        grid = F.affine_grid(self._Affine(n, device), (n, 1) + tuple(output_size), align_corners=False)
+        if 'elastic' in self.param:
+            grid = grid + self._Elastic(n, output_size, device)
+        return grid
+
+    def Geometric(self, images, dis_map):
+        n, channel, depth, height, width = images.shape
+        grid = self.Grid(n, (height, width), images.device)
+        stack = torch.cat([images, dis_map], dim=1).flatten(1, 2)
+        stack = F.grid_sample(stack, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        stack = stack.view(n, channel + dis_map.shape[1], depth, height, width)
+        return stack[:, :channel], stack[:, channel:]
+
+    def Intensity(self, images):
+        n, _, _, height, width = images.shape
+        device = images.device
+        if 'bias' in self.param:
+            center = SampleParam(self.param['bias']['center'], n, device).view(n, 2, 1, 1)
+            drop_ratio = SampleParam(self.param['bias']['drop_ratio'], n, device).view(n, 1, 1)
+            y, x = torch.meshgrid(torch.linspace(-1, 1, height, device=device),
+                                  torch.linspace(-1, 1, width, device=device), indexing='ij')
+            distance = (x - center[:, 0]) ** 2 + (y - center[:, 1]) ** 2
+            distance = distance / distance.flatten(1).max(dim=1)[0].view(n, 1, 1)
+            images = images * (1 - drop_ratio * distance).view(n, 1, 1, height, width)
+        if 'noise' in self.param:
+            sigma = SampleParam(self.param['noise']['noise_sigma'], n, device).view(n, 1, 1, 1, 1)
+            images = images + torch.randn_like(images) * sigma
+        if 'contrast' in self.param:
+            factor = SampleParam(self.param['contrast']['factor'], n, device).view(n, 1, 1, 1, 1)
+            mean = images.mean(dim=(2, 3, 4), keepdim=True)
+            images = (images - mean) * factor + mean
+        if 'gamma' in self.param:
+            gamma = SampleParam(self.param['gamma']['gamma'], n, device).view(n, 1, 1, 1, 1)
+            low = images.amin(dim=(2, 3, 4), keepdim=True)
+            high = images.amax(dim=(2, 3, 4), keepdim=True)
+            scale = (high - low).clamp_min(1e-6)
+            images = low + scale * ((images - low) / scale).clamp(0, 1) ** gamma
+        return images
+
+    def __call__(self, images, dis_map):
+        with torch.no_grad():
+            images, dis_map = self.Geometric(images, dis_map)
+            return self.Intensity(images), dis_map
@@ -2,6 +2,7 @@ import os
 import shutil
 
 import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
@@ -16,6 +17,8 @@ from T4T.Utility.CallBacks import EarlyStopping
 from T4T.Utility.Initial import HeWeightInit
 
 from Network2D.ResNet3D import i3_res50
+from Process.StepTimer import StepTimer
+from Process.Profiler import StepProfiler
 
 
 def ClearGraphPath(graph_path):
@@ -26,23 +29,99 @@ def ClearGraphPath(graph_path):
         os.mkdir(graph_path)
 
 
-def _GetLoader(data_root, sub_list, type_list, aug_param_config, input_shape, batch_size, shuffle, is_balance=True):
+def _GetLoader(data_root, sub_list, type_list, aug_param_config, input_shape, batch_size, shuffle, is_balance=True,
+               data_format='npy', cache=None, label_path=None):
+    if label_path is None:
+        label_path = data_root + '/label.csv'
+    if data_format != 'npy' or cache is not None:
+        return _GetCaseLoader(data_root, sub_list, type_list, aug_param_config, input_shape, batch_size, shuffle,
+                              is_balance, data_format=data_format, cache=cache, label_path=label_path)
+
     data = DataManager(sub_list=sub_list, augment_param=aug_param_config)
     for type in type_list:
         data.AddOne(Image2D(data_root + '/{}'.format(type), shape=input_shape))
         # data.AddOne(Image2D(data_root + '/Eser', shape=input_shape))
         # data.AddOne(Image2D(data_root + '/T2', shape=input_shape))
     data.AddOne(Image2D(data_root + '/RoiDilated', shape=input_shape))
-    data.AddOne(Label(data_root + '/label.csv'), is_input=False)
+    data.AddOne(Label(label_path), is_input=False)
+    if is_balance:
+        data.Balance(Label(label_path))
+
+    loader = DataLoader(data, batch_size=batch_size, shuffle=shuffle, num_workers=8, pin_memory=True)
+    batches = np.ceil(len(data.indexes) / batch_size)
+    return loader, batches
+
+
+def _GetCaseLoader(data_root, sub_list, type_list, aug_param_config, input_shape, batch_size, shuffle,
+                   is_balance=True, data_format='container', cache=None, label_path=None):
+    '''
+    npy: data_root/{type}/{case}.npy read by NpyDataset (used with cache, otherwise _GetLoader reads them with T4T)
+    container: one npz per case in data_root/Container, see DataPreprocess/CaseContainer.ConvertToContainer
+    memmap / memmap16: the whole cohort in one memmap in data_root/Cohort(16), built once by BuildCohort
+    cache: a SharedSampleCache shared by the loaders of all the folds (npy and container)
+    label_path: the label csv, data_root/label.csv by default
+    '''
+    if aug_param_config is not None:
+        raise ValueError('the {} data is not augmented per sample, use batch_augment for training'.format(data_format))
+
+    data = _GetCaseDataset(data_root, sub_list, type_list, input_shape, data_format=data_format, cache=cache,
+                           label_path=label_path)
     if is_balance:
-        data.Balance(Label(data_root + '/label.csv'))
+        data.Balance()
 
     loader = DataLoader(data, batch_size=batch_size, shuffle=shuffle, num_workers=8, pin_memory=True)
     batches = np.ceil(len(data.indexes) / batch_size)
     return loader, batches
 
 
-def EnsembleTrain(device, model_root, model_name, data_root, type_list):
+def _GetCaseDataset(data_root, sub_list, type_list, input_shape, data_format='container', cache=None,
+                    label_path=None):
+    from Process.CaseDataset import CaseDataset, NpyDataset, GetCohortDataset
+    if label_path is None:
+        label_path = data_root + '/label.csv'
+    if data_format == 'npy':
+        data = NpyDataset(data_root, sub_list, type_list, label_path, shape=input_shape, cache=cache)
+    elif data_format == 'container':
+        data = CaseDataset(data_root + '/Container', sub_list, type_list, label_path, shape=input_shape, cache=cache)
+    elif data_format in ['memmap', 'memmap16']:
+        data = GetCohortDataset(data_root, sub_list, type_list, shape=input_shape, data_format=data_format,
+                                label_path=label_path)
+    else:
+        raise ValueError('unknown data_format: {}'.format(data_format))
+    return data
+
+
+def EnsembleTrain(device, model_root, model_name, data_root, type_list, data_format='npy', is_check=True,
+                  batch_augment=False, n_elastic_field=256, n_elastic_refresh=1, n_view=1, cache_mb=0,
+                  persistent_workers=False, n_prefetch=2, cache_val=None, val_batch_size=None, val_every=1,
+                  step_timing=False, profile_steps=None, catalog=None):
+    '''
+    batch_augment: param_config is applied to each batch on the device (Process/BatchAugment) instead of per sample in
+    the DataLoader workers. The container / memmap data_format are only augmented this way.
+    n_elastic_field: size of the precomputed elastic field bank of the batch augmentation, 0 for a new field per sample.
+    n_elastic_refresh: fields of the bank regenerated at each draw, in turn (0 keeps the bank fixed).
+    n_view: each loaded case is repeated n_view times in its batch, and every copy gets its own batch augmentation
+        (the random shift plays the random crop). The loader reads batch_size // n_view cases per batch in the
+        balanced order, so a batch still holds about batch_size samples and each case is read once per epoch.
+    cache_mb: memory budget of a shared-memory cache of the decoded samples (Process/SampleCache), filled once and read
+        by the workers of all the folds, the least recently used samples are evicted. npy and container data_format,
+        the training batches are then augmented on the device.
+    persistent_workers: one pool of DataLoader workers over the whole cohort for all the folds (Process/WorkerPool),
+        each fold swaps its index list into it; n_prefetch batches are loaded ahead per worker. The training batches
+        are then augmented on the device.
+    cache_val: 'device' or 'pinned', the validation data of each fold is read once and kept on the device or in pinned
+        memory (Process/ValidationSet), then validated in batches of val_batch_size (4 * batch_size by default).
+    val_every: validate every val_every epochs (and at the last one). The patience of the scheduler and of the early
+        stopping are counted in validations, so they are divided by val_every to keep the same number of epochs.
+    step_timing: the wall time of the phases of each training step (data wait, h2d, augment, forward, backward, step,
+        metrics) and of the epoch (validation, histogram) in log/step_timing.csv and TensorBoard (Process/StepTimer),
+        with the data wait percentage and the samples per second.
+    profile_steps: (warmup, active) or (wait, warmup, active) training steps traced by torch.profiler in the first
+        fold, to model_folder/Profile (Process/Profiler); also set by the environment variable BREAST_PROFILE.
+    catalog: a CaseCatalog (DataPreprocess/CaseCatalog), its cases and labels replace data_root/label.csv (the labels
+        are written to model_folder/label.csv for the loaders); the samples are still read from data_root in
+        data_format and the folds still come from DataSpliter on alltrain_label.csv.
+    '''
     torch.autograd.set_detect_anomaly(True)
 
     input_shape = (100, 100)
@@ -52,6 +131,11 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
     model_folder = MakeFolder(model_root + '/{}'.format(model_name))
     if os.path.exists(model_folder):
         ClearGraphPath(model_folder)
+    if is_check:
+        # the npy headers of every case, a broken file stops here instead of in a DataLoader worker
+        from DataPreprocess.NpyAudit import CheckNpy
+        CheckNpy(data_root, list(type_list) + ['RoiDilated'], split_list=('alltrain_label.csv', ),
+                 input_shape=input_shape, save_path=os.path.join(model_folder, 'npy_scan.csv'))
 
     param_config = {
         RotateTransform.name: {'theta': ['uniform', -10, 10]},
@@ -68,12 +152,60 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
         ElasticTransform.name: ['elastic', 1, 0.1, 256]
     }
 
+    if catalog is not None:
+        case_list = catalog.Cases()
+        label_path = os.path.join(model_folder, 'label.csv')
+        pd.DataFrame({'CaseName': case_list, 'Label': [catalog.Label(case) for case in case_list]}).to_csv(
+            label_path, index=False)
+    else:
+        case_list = pd.read_csv(data_root + '/label.csv', index_col='CaseName').index.tolist()
+        label_path = data_root + '/label.csv'
+    cache = None
+    if cache_mb > 0 and data_format in ['npy', 'container']:
+        from Process.SampleCache import SharedSampleCache
+        probe_loader, _ = _GetCaseLoader(data_root, case_list[:1], type_list, None, input_shape, 1, False,
+                                         is_balance=False, data_format=data_format, label_path=label_path)
+        sample_shape = (len(type_list) + 1, ) + tuple(probe_loader.dataset.LoadCase(0)[0].shape)
+        cache = SharedSampleCache(case_list, sample_shape, budget_mb=cache_mb)
+        del probe_loader
+    pool = None
+    if persistent_workers:
+        from Process.CaseDataset import BalanceIndex
+        from Process.WorkerPool import PersistentWorkerPool
+        pool_data = _GetCaseDataset(data_root, case_list, type_list, input_shape, data_format=data_format, cache=cache,
+                                    label_path=label_path)
+        pool_index = {case: index for index, case in enumerate(pool_data.case_list)}
+        pool = PersistentWorkerPool(pool_data, n_workers=8, n_prefetch=n_prefetch)
+
+    profiler = StepProfiler(os.path.join(model_folder, 'Profile'), 'train', profile_steps)
+
     spliter = DataSpliter()
     cv_generator = spliter.SplitLabelCV(r'/home/zhangyihong/Documents/BreastNpy/alltrain_label.csv', store_root=Path(model_folder))
     for cv_index, (sub_train, sub_val) in enumerate(cv_generator):
         sub_model_folder = MakeFolder(Path(model_folder) / 'CV_{}'.format(cv_index))
-        train_loader, train_batches = _GetLoader(data_root, sub_train, type_list, param_config, input_shape, batch_size, True)
-        val_loader, val_batches = _GetLoader(data_root, sub_val, type_list, None, input_shape, batch_size, False)
+        if pool is not None:
+            from Process.BatchAugment import BatchAugment
+            augment = BatchAugment(param_config, n_elastic_field=n_elastic_field, n_refresh=n_elastic_refresh)
+            train_index = BalanceIndex(pool_data.label_list, [pool_index[case] for case in sub_train])
+            train_loader, train_batches = pool.Loader(train_index, max(1, batch_size // n_view), True)
+            val_loader, val_batches = pool.Loader([pool_index[case] for case in sub_val], batch_size, False)
+        elif batch_augment or data_format != 'npy' or n_view > 1 or cache is not None:
+            from Process.BatchAugment import BatchAugment
+            augment = BatchAugment(param_config, n_elastic_field=n_elastic_field, n_refresh=n_elastic_refresh)
+            train_loader, train_batches = _GetLoader(data_root, sub_train, type_list, None, input_shape,
+                                                     max(1, batch_size // n_view), True, data_format=data_format,
+                                                     cache=cache, label_path=label_path)
+        else:
+            augment = None
+            train_loader, train_batches = _GetLoader(data_root, sub_train, type_list, param_config, input_shape,
+                                                     batch_size, True, label_path=label_path)
+        if pool is None:
+            val_loader, val_batches = _GetLoader(data_root, sub_val, type_list, None, input_shape, batch_size, False,
+                                                 data_format=data_format, cache=cache, label_path=label_path)
+        val_set = None
+        if cache_val is not None:
+            from Process.ValidationSet import ValidationSet
+            val_set = ValidationSet(val_loader, device, on_device=cache_val == 'device')
 
         model = i3_res50(len(type_list), 1)
         if torch.cuda.device_count() > 1:
@@ -85,9 +217,12 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
 
         optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
         bce_loss = torch.nn.BCEWithLogitsLoss()
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=10, factor=0.5, verbose=True)
-        early_stopping = EarlyStopping(store_path=str(sub_model_folder / '{}-{:.6f}.pt'), patience=50, verbose=True)
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=int(np.ceil(10 / val_every)),
+                                                               factor=0.5, verbose=True)
+        early_stopping = EarlyStopping(store_path=str(sub_model_folder / '{}-{:.6f}.pt'),
+                                       patience=int(np.ceil(50 / val_every)), verbose=True)
         writer = SummaryWriter(log_dir=str(sub_model_folder / 'log'), comment='Net')
+        timer = StepTimer(sub_model_folder / 'log', device, enabled=step_timing)
 
         for epoch in range(total_epoch):
             train_loss, val_loss = 0., 0.
@@ -95,24 +230,40 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
             train_label, val_label = [], []
 
             model.train()
+            timer.Start()
             for ind, (inputs, outputs) in enumerate(train_loader):
+                timer.Mark('data')
                 if (epoch == 0 and cv_index == 0 and ind == 0): print('input channel = {}'.format(len(inputs) - 1))
                 dis_map = MoveTensorsToDevice(torch.unsqueeze(inputs[-1], dim=1), device)
                 inputs = MoveTensorsToDevice(torch.stack(inputs[:-1], dim=1), device)
                 outputs = MoveTensorsToDevice(outputs, device)
+                timer.Mark('h2d')
+                if n_view > 1:
+                    inputs = torch.repeat_interleave(inputs, n_view, dim=0)
+                    dis_map = torch.repeat_interleave(dis_map, n_view, dim=0)
+                    outputs = torch.repeat_interleave(outputs, n_view, dim=0)
+                if augment is not None:
+                    inputs, dis_map = augment(inputs, dis_map)
+                timer.Mark('augment')
 
                 preds = model([inputs, dis_map])
+                timer.Mark('forward')
 
                 optimizer.zero_grad()
 
                 loss = bce_loss(preds, torch.unsqueeze(outputs, dim=1))
                 loss.backward()
+                timer.Mark('backward')
                 optimizer.step()
+                timer.Mark('step')
 
                 train_loss += loss.item()
 
                 train_pred.append(torch.sigmoid(torch.squeeze(preds)).detach())
                 train_label.append(outputs.data)
+                timer.Mark('metrics')
+                timer.Step(len(outputs))
+                profiler.Step()
 
             train_label = torch.cat(train_label)
             train_pred = torch.cat(train_pred)
@@ -122,44 +273,72 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
 
             train_acc = torch.sum(train_label == binary_pred) / train_pred.shape[0]
             train_auc = roc_auc_score(train_label.tolist(), train_pred.tolist())
+            timer.Mark('metrics')
+
+            if (epoch + 1) % val_every != 0 and epoch + 1 != total_epoch:
+                # the scheduler and the early stopping only see the validated epochs
+                writer.add_scalars('Loss', {'train_loss': train_loss / train_batches}, epoch + 1)
+                writer.add_scalars('Acc', {'train_acc': train_acc}, epoch + 1)
+                writer.add_scalars('AUC', {'train_auc': train_auc}, epoch + 1)
+                print('Epoch {}:\tloss: {:.3f}; acc: {:.3f}; auc: {:.3f}'.format(
+                    epoch + 1, train_loss / train_batches, train_acc, train_auc))
+                if step_timing:
+                    print(timer.Epoch(epoch, writer))
+                writer.flush()
+                continue
 
             model.eval()
             with torch.no_grad():
-                for ind, (inputs, outputs) in enumerate(val_loader):
-                    dis_map = MoveTensorsToDevice(torch.unsqueeze(inputs[-1], dim=1), device)
-                    inputs = MoveTensorsToDevice(torch.stack(inputs[:-1], dim=1), device)
-                    outputs = MoveTensorsToDevice(outputs, device)
+                if val_set is not None:
+                    for inputs, dis_map, outputs in val_set.Batches(val_batch_size or 4 * batch_size):
+                        preds = model([inputs, dis_map])
+                        loss = bce_loss(preds, torch.unsqueeze(outputs, dim=1))
+                        val_loss += loss.item() * len(outputs)
+
+                        val_pred.append(torch.sigmoid(torch.squeeze(preds, dim=1)).detach())
+                        val_label.append(outputs)
+                else:
+                    for ind, (inputs, outputs) in enumerate(val_loader):
+                        dis_map = MoveTensorsToDevice(torch.unsqueeze(inputs[-1], dim=1), device)
+                        inputs = MoveTensorsToDevice(torch.stack(inputs[:-1], dim=1), device)
+                        outputs = MoveTensorsToDevice(outputs, device)
 
-                    preds = model([inputs, dis_map])
+                        preds = model([inputs, dis_map])
 
-                    loss = bce_loss(preds, torch.unsqueeze(outputs, dim=1))
+                        loss = bce_loss(preds, torch.unsqueeze(outputs, dim=1))
 
-                    val_loss += loss.item()
+                        val_loss += loss.item() * len(outputs)
 
-                    val_pred.append(torch.sigmoid(torch.squeeze(preds)).detach())
-                    val_label.append((outputs.data))
+                        val_pred.append(torch.sigmoid(torch.squeeze(preds)).detach())
+                        val_label.append((outputs.data))
 
             val_label = torch.cat(val_label)
             val_pred = torch.cat(val_pred)
+            # the mean loss per validation case, whatever the batch size and the size of the last batch
+            val_loss = val_loss / len(val_label)
             binary_pred = deepcopy(val_pred)
             binary_pred[binary_pred >= 0.5] = 1
             binary_pred[binary_pred < 0.5] = 0
 
             val_acc = torch.sum(val_label == binary_pred) / val_pred.shape[0]
             val_auc = roc_auc_score(val_label.tolist(), val_pred.tolist())
+            timer.Mark('validation')
 
             # Save Tensor Board
             for index, (name, param) in enumerate(model.named_parameters()):
                 if 'bn' not in name:
                     writer.add_histogram(name + '_data', param.cpu().detach().numpy(), epoch + 1)
+            timer.Mark('histogram')
 
-            writer.add_scalars('Loss', {'train_loss': train_loss / train_batches, 'val_loss': val_loss / val_batches},
+            writer.add_scalars('Loss', {'train_loss': train_loss / train_batches, 'val_loss': val_loss},
                                epoch + 1)
             writer.add_scalars('Acc', {'train_acc': train_acc, 'val_acc': val_acc}, epoch + 1)
             writer.add_scalars('AUC', {'train_auc': train_auc, 'val_auc': val_auc}, epoch + 1)
 
             print('Epoch {}:\tloss: {:.3f}, val-loss: {:.3f}; acc: {:.3f}, val-acc: {:.3f}; auc: {:.3f}, val-auc: {:.3f}'.format(
-                epoch + 1, train_loss / train_batches, val_loss / val_batches, train_acc, val_acc, train_auc, val_auc))
+                epoch + 1, train_loss / train_batches, val_loss, train_acc, val_acc, train_auc, val_auc))
+            if step_timing:
+                print(timer.Epoch(epoch, writer))
 
             scheduler.step(val_loss)
             early_stopping(val_loss, model, (epoch + 1, val_loss))
@@ -169,8 +348,11 @@ def EnsembleTrain(device, model_root, model_name, data_root, type_list):
                 break
             writer.flush()
         writer.close()
+        if cache is not None:
+            print(cache.Report())
 
         del writer, optimizer, scheduler, early_stopping, model
+    profiler.Stop()
 
 
 def CheckInput(device, model_folder, model_name, data_root):
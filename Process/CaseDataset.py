@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset
+
+from DataPreprocess.CaseContainer import LoadContainer
+
+
+def CenterCrop2D(data, shape):
+    ''' crop the last two axes of data to shape around the center, like Image2D(shape=...) '''
+    if shape is None:
+        return data
+    height, width = data.shape[-2:]
+    top, left = max((height - shape[0]) // 2, 0), max((width - shape[1]) // 2, 0)
+    return data[..., top: top + shape[0], left: left + shape[1]]
+
+
+def BalanceIndex(label_list, index_list):
+    ''' repeat the indexes of the smaller classes until every class has as many samples as the largest one '''
+    index_array = np.asarray(list(index_list))
+    label_array = np.asarray(label_list)[index_array]
+    class_index = [index_array[label_array == label].tolist() for label in np.unique(label_array)]
+    max_count = max([len(one) for one in class_index])
+    balance_index = []
+    for one in class_index:
+        balance_index.extend((one * (max_count // len(one) + 1))[:max_count])
+    return balance_index
+
+
+class CaseDataset(Dataset):
+    '''
+    Reads one container per sample (DataPreprocess/CaseContainer), returns the same (inputs, label) as the
+    DataManager of _GetLoader: inputs = [type_list..., RoiDilated].
+    transform(data_list) -> data_list is applied jointly to all inputs of one sample.
+    cache: a SharedSampleCache (Process/SampleCache), the decoded samples are read from it before the transform.
+    '''
+    def __init__(self, container_root, sub_list, type_list, label_path, shape=None, transform=None,
+                 roi_name='RoiDilated', cache=None):
+        super(CaseDataset, self).__init__()
+        self.container_root = container_root
+        self.channel_list = list(type_list) + [roi_name]
+        self.shape = shape
+        self.transform = transform
+        self.cache = cache
+
+        label_df = pd.read_csv(label_path, index_col='CaseName')
+        self.case_list = list(sub_list)
+        self.label_list = [float(label_df.loc[case, 'Label']) for case in self.case_list]
+        self.indexes = list(range(len(self.case_list)))
+
+    def Balance(self):
+        self.indexes = BalanceIndex(self.label_list, range(len(self.case_list)))
+
+    def LoadCase(self, index):
+        case = self.case_list[index]
+        data_dict, _ = LoadContainer('{}/{}.npz'.format(self.container_root, case), self.channel_list)
+        return [np.asarray(CenterCrop2D(data_dict[channel], self.shape), dtype=np.float32)
+                for channel in self.channel_list]
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, item):
+        index = self.indexes[item]
+        if self.cache is not None:
+            data_list = self.cache.Get(self.case_list[index], lambda: self.LoadCase(index))
+        else:
+            data_list = self.LoadCase(index)
+        if self.transform is not None:
+            data_list = self.transform(data_list)
+        return [np.ascontiguousarray(data) for data in data_list], np.float32(self.label_list[index])
+
+
+class NpyDataset(CaseDataset):
+    ''' Reads data_root/{channel}/{case}.npy, the same files as the Image2D inputs of _GetLoader '''
+    def LoadCase(self, index):
+        case = self.case_list[index]
+        return [np.asarray(CenterCrop2D(np.load('{}/{}/{}.npy'.format(self.container_root, channel, case)), self.shape),
+                           dtype=np.float32) for channel in self.channel_list]
+
+
+def SourceFingerprint(data_root, channel_list, case_list):
+    ''' md5 of the size and mtime (ns) of every data_root/{channel}/{case}.npy '''
+    md5 = hashlib.md5()
+    for channel in channel_list:
+        for case in case_list:
+            stat = os.stat(os.path.join(data_root, channel, '{}.npy'.format(case)))
+            md5.update('{}/{} {} {}\n'.format(channel, case, stat.st_size, stat.st_mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def BuildCohort(data_root, cohort_folder, type_list, shape=(100, 100), dtype='float32', roi_name='RoiDilated'):
+    '''
+    Stack data_root/{type}/{case}.npy of every case into one (case, channel, slice, height, width) npy that is
+    opened as memmap, with cohort_index.csv (CaseName -> row) and cohort_meta.json. An existing cohort with the same
+    channels, cases, crop shape and dtype, built from the same source npys (SourceFingerprint), is reused.
+    '''
+    channel_list = list(type_list) + [roi_name]
+    cohort_path = os.path.join(cohort_folder, 'cohort.npy')
+    index_path = os.path.join(cohort_folder, 'cohort_index.csv')
+    meta_path = os.path.join(cohort_folder, 'cohort_meta.json')
+
+    case_list = sorted([one[:-len('.npy')] for one in os.listdir(os.path.join(data_root, roi_name)) if one.endswith('.npy')])
+    first = CenterCrop2D(np.load(os.path.join(data_root, roi_name, '{}.npy'.format(case_list[0])), mmap_mode='r'),
+                         shape)
+    source = SourceFingerprint(data_root, channel_list, case_list)
+    if os.path.exists(meta_path) and os.path.exists(cohort_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['channel'] == channel_list and meta['dtype'] == dtype and meta['case'] == case_list and \
+                meta['shape'] == list(first.shape) and meta.get('source') == source:
+            return cohort_path
+        # a build stopped halfway must not be reused with the old meta
+        os.remove(meta_path)
+
+    if not os.path.exists(cohort_folder):
+        os.makedirs(cohort_folder)
+    cohort = np.lib.format.open_memmap(cohort_path, mode='w+', dtype=dtype,
+                                       shape=(len(case_list), len(channel_list)) + first.shape)
+    for index, case in enumerate(case_list):
+        for channel_index, channel in enumerate(channel_list):
+            data = np.load(os.path.join(data_root, channel, '{}.npy'.format(case)))
+            cohort[index, channel_index] = CenterCrop2D(data, shape)
+    cohort.flush()
+    del cohort
+
+    pd.DataFrame({'CaseName': case_list, 'Index': list(range(len(case_list)))}).to_csv(index_path, index=False)
+    with open(meta_path, 'w') as f:
+        json.dump({'channel': channel_list, 'dtype': dtype, 'shape': list(first.shape), 'case': case_list,
+                   'source': source}, f)
+    return cohort_path
+
+
+class CohortDataset(CaseDataset):
+    '''
+    Reads the samples from the memmap of BuildCohort. The memmap is opened lazily in each DataLoader worker, all
+    workers share the pages of the file through the OS page cache.
+    '''
+    def __init__(self, cohort_folder, sub_list, type_list, label_path, transform=None, roi_name='RoiDilated'):
+        super(CohortDataset, self).__init__(cohort_folder, sub_list, type_list, label_path, transform=transform,
+                                            roi_name=roi_name)
+        with open(os.path.join(cohort_folder, 'cohort_meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.channel_index = [meta['channel'].index(channel) for channel in self.channel_list]
+        index_df = pd.read_csv(os.path.join(cohort_folder, 'cohort_index.csv'), index_col='CaseName')
+        self.row_list = [int(index_df.loc[case, 'Index']) for case in self.case_list]
+        self.cohort_path = os.path.join(cohort_folder, 'cohort.npy')
+        self.cohort = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cohort'] = None
+        return state
+
+    def LoadCase(self, index):
+        if self.cohort is None:
+            self.cohort = np.load(self.cohort_path, mmap_mode='r')
+        case_data = self.cohort[self.row_list[index]]
+        return [case_data[channel_index].astype(np.float32, copy=False) for channel_index in self.channel_index]
+
+
+def GetCohortDataset(data_root, sub_list, type_list, shape=(100, 100), data_format='memmap', label_path=None):
+    '''
+    memmap: float32 cohort in data_root/Cohort, memmap16: float16 cohort in data_root/Cohort16
+    label_path: data_root/label.csv by default
+    '''
+    is_half = data_format == 'memmap16'
+    cohort_folder = data_root + ('/Cohort16' if is_half else '/Cohort')
+    BuildCohort(data_root, cohort_folder, type_list, shape=shape, dtype='float16' if is_half else 'float32')
+    return CohortDataset(cohort_folder, sub_list, type_list,
+                         data_root + '/label.csv' if label_path is None else label_path)
@@ -11,23 +11,32 @@ from MeDIT.Statistics import BinaryClassification
 from Network2D.ResNet3D import i3_res50
 
 
-def EnsembleInference(model_root, data_root, model_name, data_type, type_list, weights_list=None):
+def EnsembleInference(model_root, data_root, model_name, data_type, type_list, weights_list=None, data_format='npy',
+                      catalog=None):
+    ''' data_type: the split csv, e.g. test.csv; with catalog (DataPreprocess/CaseCatalog) the split is looked up in it '''
     input_shape = (100, 100)
     batch_size = 48
     model_folder = os.path.join(model_root, model_name)
 
-    sub_list = pd.read_csv(os.path.join(data_root, '{}'.format(data_type)), index_col='CaseName').index.tolist()
+    if catalog is not None:
+        sub_list = catalog.Cases(os.path.splitext(data_type)[0])
+    else:
+        sub_list = pd.read_csv(os.path.join(data_root, '{}'.format(data_type)), index_col='CaseName').index.tolist()
 
-    data = DataManager(sub_list=sub_list)
-    for type in type_list:
-        data.AddOne(Image2D(data_root + '/{}'.format(type), shape=input_shape))
+    if data_format in ['memmap', 'memmap16']:
+        from Process.CaseDataset import GetCohortDataset
+        data = GetCohortDataset(data_root, sub_list, type_list, shape=input_shape, data_format=data_format)
+    else:
+        data = DataManager(sub_list=sub_list)
+        for type in type_list:
+            data.AddOne(Image2D(data_root + '/{}'.format(type), shape=input_shape))
+            # data.AddOne(Image2D(data_root + '/Eser', shape=input_shape))
+            # data.AddOne(Image2D(data_root + '/T2', shape=input_shape))
+        # data.AddOne(Image2D(data_root + '/Adc', shape=input_shape))
         # data.AddOne(Image2D(data_root + '/Eser', shape=input_shape))
         # data.AddOne(Image2D(data_root + '/T2', shape=input_shape))
-    # data.AddOne(Image2D(data_root + '/Adc', shape=input_shape))
-    # data.AddOne(Image2D(data_root + '/Eser', shape=input_shape))
-    # data.AddOne(Image2D(data_root + '/T2', shape=input_shape))
-    data.AddOne(Image2D(data_root + '/RoiDilated', shape=input_shape))
-    data.AddOne(Label(data_root + '/label.csv'), is_input=False)
+        data.AddOne(Image2D(data_root + '/RoiDilated', shape=input_shape))
+        data.AddOne(Label(data_root + '/label.csv'), is_input=False)
 
     loader = DataLoader(data, batch_size=batch_size, num_workers=2, pin_memory=True)
 
@@ -156,9 +165,10 @@ if __name__ == '__main__':
 
 
 
-    label_df = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpy/label.csv', index_col='CaseName')
-    alltrain_list = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpy/alltrain_label.csv', index_col='CaseName').index.tolist()
-    test_list = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpy/test.csv', index_col='CaseName').index.tolist()
+    from DataPreprocess.CaseCatalog import OpenCatalog
+    catalog = OpenCatalog(os.path.join(data_root, 'case_catalog.db'), data_root)
+    alltrain_list = catalog.Cases('alltrain_label')
+    test_list = catalog.Cases('test')
     case_list, label_list = [], []
     combine_model = r'/home/zhangyihong/Documents/BreastNpy/Model/ResNet3D_20220225_Einitial'
     adc_model = r'/home/zhangyihong/Documents/BreastNpy/Model/ResNet3D_20220225_DWIb2000'
@@ -167,7 +177,7 @@ if __name__ == '__main__':
 
     for case in sorted(test_list):
         case_list.append(case)
-        label_list.append(label_df.loc[case]['Label'])
+        label_list.append(catalog.Label(case))
     combine_pred = np.load(os.path.join(combine_model, 'test_preds.npy')).tolist()
     adc_pred = np.load(os.path.join(adc_model, 'test_preds.npy')).tolist()
     eser_pred = np.load(os.path.join(eser_model, 'test_preds.npy')).tolist()
@@ -186,7 +196,7 @@ if __name__ == '__main__':
     case_list, label_list = [], []
     for case in sorted(alltrain_list):
         case_list.append(case)
-        label_list.append(label_df.loc[case]['Label'])
+        label_list.append(catalog.Label(case))
     combine_pred = np.load(os.path.join(combine_model, 'alltrain_preds.npy')).tolist()
     adc_pred = np.load(os.path.join(adc_model, 'alltrain_preds.npy')).tolist()
     eser_pred = np.load(os.path.join(eser_model, 'alltrain_preds.npy')).tolist()
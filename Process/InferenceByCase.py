@@ -9,115 +9,126 @@ from sklearn.metrics import roc_auc_score, roc_curve
 
 from MeDIT.Others import IterateCase
 from Network2D.ResNet3D import i3_res50
+from Process.Profiler import StepProfiler
 from T4T.Utility.Data import MoveTensorsToDevice
+from DataPreprocess.WriteBehind import WriteBehind, SaveFigure
+
+
+preprocess_type_list = ['ADC_Reg.nii.gz', 'ESER_1.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii']
+preprocess_folder_list = ['Adc', 'Eser', 'T2', 'Roi', 'RoiDilated']
+
+
+def _LoadCase(task):
+    from MeDIT.SaveAndLoad import LoadImage
+    case, path_list, label, target_spacing = task
+    image_list, data_list = [], []
+    for data_path in path_list:
+        image, data, _ = LoadImage(data_path, is_show_info=False)
+        image_list.append(image)
+        data_list.append(data)
+    if target_spacing is not None:
+        from DataPreprocess.Resample import ResampleImageList
+        data_list = ResampleImageList(image_list, target_spacing)
+    return case, image_list, data_list, label
 
 
 class InferenceByCase():
-    def __init__(self):
+    attention_param = {'base_rate': 0.1, 'resolution': (1.5, 1.0, 1.0)}
+
+    def __init__(self, target_spacing=None):
+        '''
+        With target_spacing (x, y, z mm), the loaded cases are resampled onto it (DataPreprocess/Resample) and the
+        attention map uses it as resolution.
+        '''
         super(InferenceByCase).__init__()
+        self.target_spacing = target_spacing
+        if target_spacing is not None:
+            from DataPreprocess.Resample import AttentionResolution
+            self.attention_param = dict(self.attention_param, resolution=AttentionResolution(target_spacing))
 
 
     def __GetCenter(self, roi):
+        from DataPreprocess.RoiGeometry import RoiGeometry, GeometryCenter
         assert (np.ndim(roi) == 3)
-        roi = np.squeeze(roi)
-        non_zero = np.nonzero(roi)
-        center_y = int(np.median(np.unique(non_zero[0])))
-        center_x = int(np.median(np.unique(non_zero[1])))
-        center_z = int(np.median(np.unique(non_zero[2])))
+        center_y, center_x, center_z = GeometryCenter(RoiGeometry(roi))
         return (center_x, center_y, center_z)
 
 
     def __AttentionMap(self, data):
-        from scipy.ndimage.filters import median_filter, maximum_filter
-        from copy import deepcopy
-
-        def InterSliceFilter(attention, diff_value, kernel_size=(3, 1, 1)):
-            raw_attention = deepcopy(attention)
-            while True:
-                new_attention = maximum_filter(raw_attention, size=kernel_size)
-                new_attention[new_attention > raw_attention] -= diff_value
-                new_attention[new_attention < 0] = 0
-
-                if not (new_attention > raw_attention).any():
-                    break
-
-                raw_attention = new_attention
-            new_attention = median_filter(new_attention, size=kernel_size)
-            new_attention = median_filter(new_attention, size=kernel_size)
-
-            return new_attention
-
-        def IntraSliceFilter(attention, diff_value, kernel_size=(1, 3, 3)):
-            raw_attention = deepcopy(attention)
-
-            while True:
-                new_attention = maximum_filter(raw_attention, size=kernel_size)
-                new_attention[new_attention > raw_attention] -= diff_value
-                new_attention[new_attention < 0] = 0
-
-                if not (new_attention > raw_attention).any():
-                    break
+        from DataPreprocess.DistanceMap import AttentionMap
+        return AttentionMap(data, **self.attention_param)
 
-                raw_attention = new_attention
 
-            new_attention = median_filter(new_attention, size=kernel_size)
-            new_attention = median_filter(new_attention, size=kernel_size)
-
-            return new_attention
-
-        base_rate = 0.1
-        resolution = (1.5, 1.0, 1.0)
-        slice_rate = resolution[0] / resolution[2] * base_rate
-        new_data = InterSliceFilter(data, slice_rate)
-        new_data = IntraSliceFilter(new_data, base_rate)
-
-        return new_data
+    def CropData3D(self, data_list, crop_shape=(100, 100, 50), is_dilated=True, center=None):
+        from DataPreprocess.CropStack import CropStack
+        '''
+        data_list[-1] must be roi, center (x, y, z) is computed from the roi if it is not given (e.g. by the roi
+        geometry index). data_list may be the roi only, when only the roi / attention map are rebuilt.
+        '''
+        assert len(data_list) > 0
+        x, y, z = self.__GetCenter(data_list[-1]) if center is None else center
+        #输入网络是slice, height, width, 只对图像做Normalization
+        cropped_data = CropStack(data_list, (y, x, z), crop_shape, n_image=len(data_list) - 1, n_extra=int(is_dilated))
+        if is_dilated:
+            cropped_data[-1] = self.__AttentionMap(cropped_data[-2])   #对ROI求attention map
+        return cropped_data   #(ESER, ADC, t2, roi, roi_dilated), slice, height, width
 
 
-    def CropData3D(self, data_list, crop_shape=(100, 100, 50), is_dilated=True):
-        from MeDIT.ArrayProcess import ExtractBlock
-        from MeDIT.Normalize import NormalizeZ
+    def LoadImage(self, data_folder,  sub_list, type_list, label_path=r'', n_prefetch=0, catalog=None):
         '''
-        data_list[-1] must be roi
+        ADC_Reg.nii.gz, ESER_1.nii.gz, t2_W_Reg.nii.gz.....roi3D.nii
+        With catalog (DataPreprocess/CaseCatalog), the labels and the file paths are looked up in it, data_folder is
+        not listed. An empty sub_list means all the labeled cases, the ones without all the files of type_list are
+        reported and skipped; a case of sub_list without them raises ValueError.
+        With n_prefetch > 0, the next n_prefetch cases are loaded on background threads, self.prefetch.wait_time is
+        the time the caller waited for the data.
         '''
-        assert len(data_list) > 1
-        x, y, z = self.__GetCenter(data_list[-1])
-        cropped_data = []
-        for index, data in enumerate(data_list):
-            cropped, _ = ExtractBlock(data, crop_shape, center_point=(y, x, z), is_shift=True)
-            cropped = cropped.transpose(2, 0, 1)         #输入网络是slice, height, width
-            if index == len(data_list) - 1:
-                cropped_data.append(cropped)
-                if is_dilated:
-                    cropped = self.__AttentionMap(cropped)   #对ROI求attention map
-                    cropped_data.append(cropped)
-            else:                                            #对图像做Normalization
-                cropped_data.append(NormalizeZ(cropped))
-        return cropped_data   #[ESER, ADC, t2, roi, roi_dilated]
-
-
-    def LoadImage(self, data_folder,  sub_list, type_list, label_path=r''):
-        ''' ADC_Reg.nii.gz, ESER_1.nii.gz, t2_W_Reg.nii.gz.....roi3D.nii '''
-        from MeDIT.SaveAndLoad import LoadImage
-        label_df = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpyCorrect/label.csv', index_col='CaseName')
-        for case in sorted(os.listdir(data_folder)):
-            if len(sub_list) == 0: pass
-            else:
-                if case not in sub_list: continue
-            case_folder = os.path.join(data_folder, case)
-            if not os.path.isdir(case_folder): continue
-
-            image_list, data_list = [], []
-            label = int(label_df.loc[case, 'Label'])
-            for data_type in type_list:
-                image, data, _ = LoadImage(os.path.join(case_folder, data_type), is_show_info=False)
-                image_list.append(image)
-                data_list.append(data)
-            yield case, image_list, data_list, label
+        task_list = []
+        if catalog is not None:
+            missing_list = []
+            for case in (sorted(sub_list) if len(sub_list) > 0 else catalog.Cases()):
+                path_list = [catalog.Path(case, data_type) for data_type in type_list]
+                if None in path_list:
+                    missing_list.append('{} ({})'.format(case, ', '.join(
+                        [data_type for data_type, path in zip(type_list, path_list) if path is None])))
+                    continue
+                task_list.append((case, path_list, int(catalog.Label(case)), self.target_spacing))
+            if len(missing_list) > 0:
+                # the requested cases must all be there, the other labeled cases are only reported
+                message = 'no file in the catalog for {} cases: {}'.format(len(missing_list), ', '.join(missing_list))
+                if len(sub_list) > 0:
+                    raise ValueError(message)
+                print(message)
+        else:
+            if not label_path or not os.path.exists(label_path):
+                label_path = r'/home/zhangyihong/Documents/BreastNpyCorrect/label.csv'
+            label_dict = pd.read_csv(label_path, index_col='CaseName')['Label'].to_dict()
+            sub_set = set(sub_list)
+            for case in sorted(os.listdir(data_folder)):
+                if len(sub_set) > 0 and case not in sub_set: continue
+                case_folder = os.path.join(data_folder, case)
+                if not os.path.isdir(case_folder): continue
+                task_list.append((case, [os.path.join(case_folder, data_type) for data_type in type_list],
+                                  int(label_dict[case]), self.target_spacing))
+
+        if n_prefetch > 0:
+            from Process.Prefetch import PrefetchLoader
+            self.prefetch = PrefetchLoader(task_list, _LoadCase, n_prefetch=n_prefetch)
+            for one in self.prefetch:
+                yield one
+        else:
+            for task in task_list:
+                yield _LoadCase(task)
 
 
     def Run(self, data_folder, model_folder, device, weights_list=None, sub_list=[], data_type='test',
-            type_list=['ADC_Reg.nii.gz', 'ESER_1.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii']):
+            type_list=['ADC_Reg.nii.gz', 'ESER_1.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii'], n_prefetch=2, catalog=None,
+            profile_steps=None):
+        '''
+        profile_steps: (warmup, active) or (wait, warmup, active) cases of the first fold traced by torch.profiler, to
+            model_folder/Profile (Process/Profiler); also set by the environment variable BREAST_PROFILE.
+        '''
+        profiler = StepProfiler(os.path.join(model_folder, 'Profile'), 'inference', profile_steps)
         cv_folder_list = [one for one in IterateCase(model_folder, only_folder=True, verbose=0)]
         cv_pred_list, cv_label_list, case_list = [], [], []
         for cv_index, cv_folder in enumerate(cv_folder_list):
@@ -143,24 +154,28 @@ class InferenceByCase():
                 for case, _, data_list, label in self.LoadImage(data_folder,
                                                                 label_path=os.path.join(data_folder, 'label.csv'),
                                                                 sub_list=sub_list,
-                                                                type_list=type_list):
-                    inputs = self.CropData3D(data_list)
-                    dis_map = MoveTensorsToDevice(torch.unsqueeze(torch.from_numpy(inputs[-1]), dim=0), device)
-                    inputs = MoveTensorsToDevice(torch.stack([torch.from_numpy(inputs[0]),
-                                                              torch.from_numpy(inputs[1]),
-                                                              torch.from_numpy(inputs[2])], dim=0), device)
+                                                                type_list=type_list,
+                                                                n_prefetch=n_prefetch,
+                                                                catalog=catalog):
+                    inputs = torch.from_numpy(self.CropData3D(data_list))
+                    dis_map = MoveTensorsToDevice(inputs[-1:], device)
+                    inputs = MoveTensorsToDevice(inputs[:-2], device)
 
                     preds = model([torch.unsqueeze(inputs, dim=0), torch.unsqueeze(dis_map, dim=0)])
 
                     pred_list.append(torch.sigmoid(torch.squeeze(preds)).detach())
                     label_list.append(torch.tensor(label))
                     if cv_index == 0: case_list.append(case)
+                    profiler.Step()
+            profiler.Stop()
 
             cv_pred_list.append(torch.stack(pred_list))
             cv_label_list.append(torch.stack(label_list))
 
             auc = roc_auc_score(torch.stack(label_list).tolist(), torch.stack(pred_list).tolist())
             print(auc)
+            if n_prefetch > 0:
+                print('data loading: {}'.format(self.prefetch.Report()))
 
             del model, weights_path
 
@@ -251,53 +266,236 @@ class InferenceByCase():
         plt.close()
 
 
-def DataPreprocess(save_figure=r'V:\yhzhang\BreastNPYCorrect'):
-    type_list = ['ADC_Reg.nii.gz', 'ESER_1.nii.gz', 't2_W_Reg.nii.gz', 'roi3D.nii']
-    inference = InferenceByCase()
-    for case, _, data_list, _ in inference.LoadImage(data_folder,
-                                                     sub_list=[],
-                                                     type_list=type_list,
-                                                     label_path=r'V:\yhzhang\BreastNPYCorrect\label.csv'):
-        cropped_data = inference.CropData3D(case, data_list, crop_shape=(120, 120, 50), is_dilated=True)
-        np.save(os.path.join(r'V:\yhzhang\BreastNpyCorrect\Adc', '{}.npy'.format(case)), cropped_data[0])
-        np.save(os.path.join(r'V:\yhzhang\BreastNpyCorrect\Eser', '{}.npy'.format(case)), cropped_data[1])
-        np.save(os.path.join(r'V:\yhzhang\BreastNpyCorrect\T2', '{}.npy'.format(case)), cropped_data[2])
-        np.save(os.path.join(r'V:\yhzhang\BreastNpyCorrect\Roi', '{}.npy'.format(case)), cropped_data[3])
-        np.save(os.path.join(r'V:\yhzhang\BreastNpyCorrect\RoiDilated', '{}.npy'.format(case)), cropped_data[4])
-
-        if save_figure:
-            from MeDIT.Visualization import FlattenImages
-
-            flatten_data = FlattenImages(cropped_data[3])
-            flatten_roi = FlattenImages(cropped_data[4])
-
-            plt.figure(figsize=(16, 8))
-            plt.subplot(121)
-            plt.axis('off')
-            plt.imshow(flatten_data, cmap='gray')
-            plt.subplot(122)
-            plt.axis('off')
-            plt.imshow(flatten_roi, cmap='gray')
-            plt.savefig(
-                os.path.join(save_figure, 'ImageDilated\{}.jpg'.format(case.split('.npy')[0])))
-            plt.close()
-
-            flatten_data = FlattenImages(cropped_data[2])
-            flatten_roi = FlattenImages(cropped_data[3])
-            plt.figure(figsize=(16, 16))
-            plt.imshow(flatten_data, cmap='gray')
-            plt.contour(flatten_roi, colors='r')
-            plt.axis('off')
-            plt.savefig(os.path.join(save_figure, 'Image\{}.jpg'.format(case.split('.npy')[0])))
-            plt.close()
-
+def PreprocessCase(case, data_folder, save_folder, save_figure, crop_shape=(120, 120, 50), geometry=None,
+                   mirror_folder=None, writer=None, target_spacing=None):
+    '''
+    Each npy is keyed by the hash of its nii files and the crop / attention map parameters (crop_cache), only the
+    outputs whose key changed are rebuilt. The crop center is read from geometry, {case: center} of the roi geometry
+    index (RoiGeometry.CenterDict).
+    With mirror_folder (DataPreprocess/NiiMirror), only the crop block of each volume is read.
+    The outputs are written with temp file + rename, so a case can be run again by another worker (CaseQueue).
+    The npy files and figures go to writer (DataPreprocess/WriteBehind), the next case is computed meanwhile.
+    data_folder is already resampled to target_spacing if it is given, which sets the attention map resolution.
+    '''
+    from MeDIT.SaveAndLoad import LoadImage
+    from DataPreprocess.CropCache import CaseCache
+
+    type_list, folder_list = preprocess_type_list, preprocess_folder_list
+    roi_index, dilated_index = len(type_list) - 1, len(type_list)
+    inference = InferenceByCase(target_spacing=target_spacing)
+    case_folder = os.path.join(data_folder, case)
+
+    cache = CaseCache(os.path.join(save_folder, 'crop_cache'), case)
+    roi_path = os.path.join(case_folder, type_list[-1])
+    key_list = [cache.Key([os.path.join(case_folder, data_type), roi_path], crop_shape=crop_shape)
+                for data_type in type_list[:-1]]
+    key_list.append(cache.Key([roi_path], crop_shape=crop_shape))
+    # method='loop' keeps the RoiDilated of the former distance transform AttentionMap out of the cache
+    key_list.append(cache.Key([roi_path], crop_shape=crop_shape, method='loop', **inference.attention_param))
+    output_list = [os.path.join(save_folder, folder, '{}.npy'.format(case)) for folder in folder_list]
+    stale_list = [index for index in range(len(folder_list))
+                  if not cache.IsValid(folder_list[index], key_list[index], output_list[index])]
+    if len(stale_list) == 0:
+        cache.Save()
+        return
+
+    image_index = [index for index in stale_list if index < roi_index]
+    if mirror_folder is not None:
+        from DataPreprocess.NiiMirror import MirrorCase, LoadMirror
+        MirrorCase(case, data_folder, mirror_folder, [type_list[index] for index in image_index + [roi_index]])
+        data_list = [LoadMirror(mirror_folder, case, type_list[index]) for index in image_index + [roi_index]]
+    else:
+        data_list = [LoadImage(os.path.join(case_folder, type_list[index]), is_show_info=False)[1]
+                     for index in image_index + [roi_index]]
+    if geometry is not None and case in geometry:
+        center_y, center_x, center_z = geometry[case]
+        center = (center_x, center_y, center_z)
+    else:
+        center = None
+    cropped_data = inference.CropData3D(data_list, crop_shape=crop_shape, is_dilated=True, center=center)
+    cropped_data = dict(zip(image_index + [roi_index, dilated_index], cropped_data))
+    for index in stale_list:
+        cache.Update(folder_list[index], key_list[index])
+    # the cache record is saved after its npy files, a crash in between only rebuilds the case
+    own_writer = writer is None
+    writer = WriteBehind() if own_writer else writer
+    writer.Submit(_WriteCase, [output_list[index] for index in stale_list],
+                  [cropped_data[index] for index in stale_list], cache)
+    print('{}: {}'.format(case, ', '.join([folder_list[index] for index in stale_list])))
+
+    if save_figure:
+        t2 = cropped_data[2] if 2 in cropped_data else np.load(output_list[2])
+        writer.Submit(_DrawCase, case, save_figure, t2, cropped_data[roi_index], cropped_data[dilated_index])
+    if own_writer:
+        writer.Close()
+
+
+def _WriteCase(output_list, data_list, cache):
+    from DataPreprocess.CropCache import SaveNpy
+    for output_path, data in zip(output_list, data_list):
+        SaveNpy(output_path, data)
+    cache.Save()
+
+
+def _DrawCase(case, save_figure, t2, roi, roi_dilated):
+    # matplotlib.figure.Figure instead of pyplot, the figures are drawn on the writer threads
+    from matplotlib.figure import Figure
+    from MeDIT.Visualization import FlattenImages
+
+    flatten_data = FlattenImages(roi)
+    flatten_roi = FlattenImages(roi_dilated)
+
+    figure = Figure(figsize=(16, 8))
+    ax = figure.add_subplot(121)
+    ax.axis('off')
+    ax.imshow(flatten_data, cmap='gray')
+    ax = figure.add_subplot(122)
+    ax.axis('off')
+    ax.imshow(flatten_roi, cmap='gray')
+    SaveFigure(figure, os.path.join(save_figure, 'ImageDilated\{}.jpg'.format(case.split('.npy')[0])))
+
+    flatten_data = FlattenImages(t2)
+    flatten_roi = FlattenImages(roi)
+    figure = Figure(figsize=(16, 16))
+    ax = figure.add_subplot(111)
+    ax.imshow(flatten_data, cmap='gray')
+    ax.contour(flatten_roi, colors='r')
+    ax.axis('off')
+    SaveFigure(figure, os.path.join(save_figure, 'Image\{}.jpg'.format(case.split('.npy')[0])))
+
+
+def CheckPartialRebuild(work_folder, crop_shape=(40, 40, 10)):
+    '''
+    A synthetic case is preprocessed, then its RoiDilated npy is deleted: the second run rebuilds it from the roi only
+    and it must equal the first one, the other outputs are left as they are.
+    '''
+    import SimpleITK as sitk
+
+    data_folder, save_folder = os.path.join(work_folder, 'nii'), os.path.join(work_folder, 'npy')
+    case_folder = os.path.join(data_folder, 'case')
+    os.makedirs(case_folder, exist_ok=True)
+    for folder in preprocess_folder_list:
+        os.makedirs(os.path.join(save_folder, folder), exist_ok=True)
+    z, y, x = np.mgrid[:16, :64, :64]
+    roi = (((z - 8) / 3.) ** 2 + ((y - 30) / 6.) ** 2 + ((x - 34) / 8.) ** 2 <= 1).astype(np.uint8)
+    for data_type in preprocess_type_list:
+        array = roi if data_type == preprocess_type_list[-1] else np.random.rand(*roi.shape).astype(np.float32)
+        sitk.WriteImage(sitk.GetImageFromArray(array), os.path.join(case_folder, data_type))
+
+    output_list = [os.path.join(save_folder, folder, 'case.npy') for folder in preprocess_folder_list]
+    PreprocessCase('case', data_folder, save_folder, '', crop_shape=crop_shape)
+    first_list = [np.load(one) for one in output_list]
+    mtime_list = [os.path.getmtime(one) for one in output_list[:-1]]
+
+    os.remove(output_list[-1])
+    PreprocessCase('case', data_folder, save_folder, '', crop_shape=crop_shape)
+    assert np.array_equal(np.load(output_list[-1]), first_list[-1])
+    assert [os.path.getmtime(one) for one in output_list[:-1]] == mtime_list
+    print('RoiDilated rebuilt from the roi only')
+# CheckPartialRebuild(r'/tmp/PartialRebuild')
+
+
+def IngestDicomCase(case, dicom_folder, roi_folder, save_folder, series_map, crop_shape=(120, 120, 50),
+                    target_spacing=None, n_readers=8):
+    '''
+    dicom_folder/case/series_map[folder] (one DICOM series per folder, e.g. {'Adc': 'ADC', 'Eser': 'ESER', 'T2': 'T2W'})
+    and roi_folder/case/roi3D.nii -> save_folder/{Adc, Eser, T2, Roi, RoiDilated}/case.npy, the same store as
+    PreprocessCase without the NIfTI conversion. The series are resampled onto the grid of the roi, or onto
+    target_spacing (x, y, z mm) if it is given.
+    '''
+    import SimpleITK as sitk
+    from DataPreprocess.CropCache import SaveNpy
+    from DataPreprocess.DicomSeries import ReadSeries
+    from DataPreprocess.Resample import TargetGrid, ResampleImage, ImageToArray
+    from DataPreprocess.RoiGeometry import RoiGeometry, GeometryCenter
+
+    roi_image = sitk.ReadImage(os.path.join(roi_folder, case, preprocess_type_list[-1]))
+    grid = TargetGrid(roi_image, target_spacing if target_spacing is not None else roi_image.GetSpacing())
+    data_list = []
+    for folder in preprocess_folder_list[:len(preprocess_type_list) - 1]:
+        image = ReadSeries(os.path.join(dicom_folder, case, series_map[folder]), n_workers=n_readers)
+        data_list.append(ImageToArray(ResampleImage(image, grid)))
+    data_list.append(ImageToArray(ResampleImage(roi_image, grid, is_roi=True)))
+
+    center_y, center_x, center_z = GeometryCenter(RoiGeometry(data_list[-1]))
+    inference = InferenceByCase(target_spacing=target_spacing)
+    cropped_data = inference.CropData3D(data_list, crop_shape=crop_shape, is_dilated=True,
+                                        center=(center_x, center_y, center_z))
+    for folder, data in zip(preprocess_folder_list, cropped_data):
+        SaveNpy(os.path.join(save_folder, folder, '{}.npy'.format(case)), data)
+
+
+def IngestDicom(dicom_folder, roi_folder, save_folder, series_map, crop_shape=(120, 120, 50), target_spacing=None,
+                n_workers=4, n_readers=8):
+    ''' IngestDicomCase on a case pool, the cases of save_folder/dicom_manifest.csv are not ingested again '''
+    from DataPreprocess.CasePool import RunCasePool
+    for folder in preprocess_folder_list:
+        if not os.path.exists(os.path.join(save_folder, folder)):
+            os.makedirs(os.path.join(save_folder, folder), exist_ok=True)
+    case_list = [case for case in sorted(os.listdir(dicom_folder)) if os.path.isdir(os.path.join(dicom_folder, case))]
+    return RunCasePool(case_list, IngestDicomCase, os.path.join(save_folder, 'dicom_manifest.csv'),
+                       n_workers=n_workers, is_resume=True, dicom_folder=dicom_folder, roi_folder=roi_folder,
+                       save_folder=save_folder, series_map=series_map, crop_shape=crop_shape,
+                       target_spacing=target_spacing, n_readers=n_readers)
+
+
+def DataPreprocess(data_folder, save_folder=r'V:\yhzhang\BreastNpyCorrect', save_figure=r'V:\yhzhang\BreastNPYCorrect',
+                   crop_shape=(120, 120, 50), mirror_folder=None, queue_folder=None, n_workers=4, lease=600,
+                   n_writers=2, max_pending=8, target_spacing=None, catalog=None):
+    '''
+    With catalog (DataPreprocess/CaseCatalog, nii_folder = data_folder), the cases with a roi and the crop centers are
+    read from it instead of listing data_folder and scanning the rois.
+    Without queue_folder the cases run one by one. With queue_folder on a shared drive, run the same call on several
+    machines, each claims the cases not done yet with n_workers processes (DataPreprocess/CaseQueue).
+    max_pending bounds the cases and figures waiting for the n_writers background writers.
+    With target_spacing (x, y, z mm), the cohort is first resampled to save_folder/Resampled (DataPreprocess/Resample)
+    and cropped from there, crop_shape is then in voxels of target_spacing.
+    '''
+    from DataPreprocess.RoiGeometry import BuildGeometryIndex, CenterDict
+    from DataPreprocess.CaseQueue import RunCaseQueue
+
+    if catalog is not None:
+        case_list = catalog.TypeCases(preprocess_type_list[-1])
+    else:
+        case_list = [case for case in sorted(os.listdir(data_folder)) if os.path.isdir(os.path.join(data_folder, case))]
+    if target_spacing is not None:
+        from DataPreprocess.Resample import ResampleCase, ResampleCohort
+        resample_folder = os.path.join(save_folder, 'Resampled')
+        if queue_folder is not None:
+            RunCaseQueue(case_list, ResampleCase, os.path.join(queue_folder, 'Resample'), n_workers=n_workers,
+                         lease=lease, data_folder=data_folder, save_folder=resample_folder,
+                         type_list=preprocess_type_list, target_spacing=target_spacing)
+        else:
+            ResampleCohort(data_folder, resample_folder, preprocess_type_list, target_spacing, n_workers=n_workers)
+        data_folder = resample_folder
+
+    # the catalog centers are only used while its rois did not change, otherwise the index is updated
+    geometry = catalog.Centers(preprocess_type_list[-1]) if catalog is not None and target_spacing is None else None
+    if geometry is None:
+        geometry = CenterDict(BuildGeometryIndex(data_folder, os.path.join(save_folder, 'roi_geometry.csv'),
+                                                 roi_name=preprocess_type_list[-1]))
+    case_kwargs = dict(data_folder=data_folder, save_folder=save_folder, save_figure=save_figure,
+                       crop_shape=crop_shape, geometry=geometry, mirror_folder=mirror_folder,
+                       target_spacing=target_spacing)
+    if queue_folder is not None:
+        return RunCaseQueue(case_list, PreprocessCase, queue_folder, n_workers=n_workers, lease=lease, **case_kwargs)
+    with WriteBehind(n_workers=n_writers, max_pending=max_pending) as writer:
+        for case in case_list:
+            PreprocessCase(case, writer=writer, **case_kwargs)
+        print(writer.Report())
 
 if __name__ == '__main__':
     model_root = r'/home/zhangyihong/Documents/BreastNpy/Model'
     data_root = r'/home/zhangyihong/Documents/BreastNpy'
+    # the nii cohort, data_folder of DataPreprocess / CheckData
+    data_folder = r'V:\jzhang\breastFormatNew'
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    alltrain_list = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpyCorrect/alltrain_label.csv', index_col='CaseName').index.tolist()
-    test_list = pd.read_csv(r'/home/zhangyihong/Documents/BreastNpyCorrect/test.csv', index_col='CaseName').index.tolist()
+    from DataPreprocess.CaseCatalog import OpenCatalog
+    catalog = OpenCatalog(r'/home/zhangyihong/Documents/BreastNpyCorrect/case_catalog.db',
+                          r'/home/zhangyihong/Documents/BreastNpyCorrect', nii_folder=data_folder,
+                          geometry_path=r'/home/zhangyihong/Documents/BreastNpyCorrect/roi_geometry.csv')
+    alltrain_list = catalog.Cases('alltrain_label')
+    test_list = catalog.Cases('test')
 
     inference = InferenceByCase()
     for model_name in ['ResNet3D_20220222', 'ResNet3D_20220223_Adc', 'ResNet3D_20220223_Eser', 'ResNet3D_20220223_T2']:
@@ -314,13 +512,15 @@ if __name__ == '__main__':
                       device=device,
                       sub_list=alltrain_list,
                       data_type='alltrain',
-                      type_list=type_list)
+                      type_list=type_list,
+                      catalog=catalog)
         inference.Run(data_folder,
                       model_folder=os.path.join(model_root, model_name),
                       device=device,
                       sub_list=test_list,
                       data_type='test',
-                      type_list=type_list)
+                      type_list=type_list,
+                      catalog=catalog)
         inference.DrawROC(os.path.join(model_root, model_name), save_folder=os.path.join(model_root, model_name))
 
 
@@ -0,0 +1,50 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class PrefetchLoader():
+    '''
+    Runs load_func(task) for the next n_prefetch tasks on background threads (or processes) and yields the results in
+    the order of task_list, so loading overlaps with the work of the consumer. At most n_prefetch results are held.
+    wait_time is the time the consumer was blocked waiting for a result.
+    '''
+    def __init__(self, task_list, load_func, n_prefetch=2, n_workers=None, use_process=False):
+        assert n_prefetch > 0
+        self.task_list = task_list
+        self.load_func = load_func
+        self.n_prefetch = n_prefetch
+        self.n_workers = n_workers if n_workers else n_prefetch
+        self.use_process = use_process
+        self.wait_time = 0.
+        self.count = 0
+
+    def __iter__(self):
+        executor_class = ProcessPoolExecutor if self.use_process else ThreadPoolExecutor
+        executor = executor_class(self.n_workers)
+        task_iter = iter(self.task_list)
+        futures = deque()
+        try:
+            for _ in range(self.n_prefetch):
+                task = next(task_iter, None)
+                if task is None: break
+                futures.append(executor.submit(self.load_func, task))
+
+            while futures:
+                start = time.time()
+                result = futures.popleft().result()
+                self.wait_time += time.time() - start
+                self.count += 1
+
+                task = next(task_iter, None)
+                if task is not None:
+                    futures.append(executor.submit(self.load_func, task))
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def Report(self):
+        return 'waited {:.1f}s for {} items ({:.2f}s each)'.format(self.wait_time, self.count,
+                                                                   self.wait_time / max(self.count, 1))
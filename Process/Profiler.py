@@ -0,0 +1,76 @@
+'''
+Operator-level trace of a few steps with torch.profiler, for EnsembleTrain (training steps) and InferenceByCase.Run
+(cases). Switched on by their profile argument or, without editing the code, by the environment variable
+BREAST_PROFILE, e.g. BREAST_PROFILE=2,3 (warmup, active) or BREAST_PROFILE=1,2,3 (wait, warmup, active).
+The Chrome trace (chrome://tracing, Perfetto) and the summary tables are written to output_folder, with the memory
+and the input shapes of the operators; the attention of the Bottleneck blocks is labelled 'Bottleneck.attention'.
+'''
+import os
+
+import torch
+from torch.profiler import profile, schedule, ProfilerActivity
+
+
+def ProfileSchedule(profile_steps=None):
+    ''' (wait, warmup, active) from profile_steps or BREAST_PROFILE, None if profiling is off '''
+    if profile_steps is None:
+        profile_steps = os.environ.get('BREAST_PROFILE', '')
+    if isinstance(profile_steps, str):
+        profile_steps = [int(one) for one in profile_steps.replace(' ', '').split(',') if one]
+    if len(profile_steps) == 0:
+        return None
+    if len(profile_steps) == 2:
+        # the first step also starts the workers and allocates the memory
+        profile_steps = [1] + list(profile_steps)
+    if len(profile_steps) != 3:
+        raise ValueError('profile steps are (warmup, active) or (wait, warmup, active): {}'.format(profile_steps))
+    return tuple(profile_steps)
+
+
+class StepProfiler():
+    '''
+    Step() after each step, the profiler stops itself after the active steps (or at Stop()).
+    name: prefix of the output files, {name}_trace.json and {name}_summary.txt.
+    '''
+    def __init__(self, output_folder, name, profile_steps=None):
+        self.steps = ProfileSchedule(profile_steps)
+        self.output_folder = str(output_folder)
+        self.name = name
+        self.profiler = None
+        if self.steps is None: return
+
+        os.makedirs(self.output_folder, exist_ok=True)
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        wait, warmup, active = self.steps
+        self.profiler = profile(activities=activities, schedule=schedule(wait=wait, warmup=warmup, active=active),
+                                on_trace_ready=self._Save, record_shapes=True, profile_memory=True)
+        self.n_step = 0
+        self.profiler.start()
+        print('profiling {} (wait, warmup, active) = {} to {}'.format(name, self.steps, self.output_folder))
+
+    def _Save(self, profiler):
+        profiler.export_chrome_trace(os.path.join(self.output_folder, '{}_trace.json'.format(self.name)))
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        average = profiler.key_averages()
+        table_list = [('self {} time'.format(device), average.table(sort_by='self_{}_time_total'.format(device),
+                                                                      row_limit=40)),
+                      ('self {} memory'.format(device), average.table(sort_by='self_{}_memory_usage'.format(device),
+                                                                        row_limit=40)),
+                      ('input shapes', profiler.key_averages(group_by_input_shape=True).table(
+                          sort_by='{}_time_total'.format(device), row_limit=60))]
+        with open(os.path.join(self.output_folder, '{}_summary.txt'.format(self.name)), 'w') as file:
+            for title, table in table_list:
+                file.write('{}\n{}\n\n'.format(title, table))
+        print('profile saved: {}'.format(os.path.join(self.output_folder, self.name)))
+
+    def Step(self):
+        if self.profiler is None: return
+        self.profiler.step()
+        self.n_step += 1
+        if self.n_step >= sum(self.steps):
+            self.Stop()
+
+    def Stop(self):
+        if self.profiler is None: return
+        self.profiler.stop()
+        self.profiler = None
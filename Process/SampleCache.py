@@ -0,0 +1,92 @@
+'''
+Cache of the decoded samples (before augmentation) in shared memory, filled once per run and read by all the
+DataLoader workers of all the folds. The memory is split into slots of one sample, when the budget is smaller than
+the cohort the least recently used sample is evicted.
+'''
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+class SharedSampleCache():
+    '''
+    case_list: all the cases that may be requested (e.g. the whole training cohort, so the folds share the cache).
+    sample_shape: (channel, slice, height, width) of one sample, the channels are stacked in the cache.
+    The slot table, the LRU ticks and the data are shared tensors, created before the workers are started.
+    The lock only guards the slot table: a slot is pinned while a worker copies from or into it, a pinned slot is never
+    evicted, and its version changes whenever it is given to another case.
+    '''
+    def __init__(self, case_list, sample_shape, budget_mb=4096, dtype=torch.float32):
+        self.case_id = {case: index for index, case in enumerate(case_list)}
+        sample_bytes = int(np.prod(sample_shape)) * torch.tensor([], dtype=dtype).element_size()
+        n_slot = max(1, min(len(case_list), int(budget_mb * 1024 * 1024 // sample_bytes)))
+        self.data = torch.zeros((n_slot, ) + tuple(sample_shape), dtype=dtype).share_memory_()
+        self.slot_case = torch.full((n_slot, ), -1, dtype=torch.int64).share_memory_()
+        self.slot_tick = torch.zeros(n_slot, dtype=torch.int64).share_memory_()
+        self.slot_pin = torch.zeros(n_slot, dtype=torch.int64).share_memory_()
+        self.slot_version = torch.zeros(n_slot, dtype=torch.int64).share_memory_()
+        self.case_slot = torch.full((len(case_list), ), -1, dtype=torch.int64).share_memory_()
+        self.counter = torch.zeros(3, dtype=torch.int64).share_memory_()      # tick, hit, miss
+        self.lock = mp.Lock()
+
+    def _Tick(self):
+        self.counter[0] += 1
+        return self.counter[0]
+
+    def _Reserve(self):
+        ''' under the lock: the least recently used unpinned slot, emptied and pinned, -1 if all are pinned '''
+        free = self.slot_pin == 0
+        if not bool(free.any()):
+            return -1
+        # an empty slot has tick 0, so it is taken before any used one
+        slot = int(torch.argmin(torch.where(free, self.slot_tick, torch.full_like(self.slot_tick, 2 ** 62))))
+        old_case = int(self.slot_case[slot])
+        if old_case >= 0:
+            self.case_slot[old_case] = -1
+        self.slot_case[slot] = -1
+        self.slot_tick[slot] = 0
+        self.slot_version[slot] += 1
+        self.slot_pin[slot] += 1
+        return slot
+
+    def Get(self, case, load_func):
+        ''' the cached channel list of case, or load_func() -> list of arrays which is then cached '''
+        case_id = self.case_id[case]
+        with self.lock:
+            slot = int(self.case_slot[case_id])
+            if slot >= 0:
+                self.slot_tick[slot] = self._Tick()
+                self.slot_pin[slot] += 1
+                version = int(self.slot_version[slot])
+
+        if slot >= 0:
+            sample = self.data[slot].float().numpy().copy()
+            with self.lock:
+                self.slot_pin[slot] -= 1
+                is_valid = int(self.slot_version[slot]) == version and int(self.slot_case[slot]) == case_id
+                if is_valid:
+                    self.counter[1] += 1
+            if is_valid:
+                return [channel for channel in sample]
+
+        data_list = load_func()
+        with self.lock:
+            self.counter[2] += 1
+            slot = self._Reserve() if int(self.case_slot[case_id]) < 0 else -1
+        if slot < 0:
+            return data_list
+
+        self.data[slot] = torch.from_numpy(np.stack(data_list)).to(self.data.dtype)
+        with self.lock:
+            self.slot_pin[slot] -= 1
+            # another worker may have cached the same case meanwhile, the slot then stays empty
+            if int(self.case_slot[case_id]) < 0:
+                self.slot_case[slot] = case_id
+                self.case_slot[case_id] = slot
+                self.slot_tick[slot] = self._Tick()
+        return data_list
+
+    def Report(self):
+        hit, miss = int(self.counter[1]), int(self.counter[2])
+        return 'sample cache: {} slots, {} cached, hit {}, miss {} ({:.1%} hit)'.format(
+            len(self.data), int((self.slot_case >= 0).sum()), hit, miss, hit / max(hit + miss, 1))
@@ -0,0 +1,71 @@
+'''
+Wall time per phase of the training steps: Mark(phase) charges the time since the previous mark to phase, Step()
+closes a step, Epoch() sums the epoch, writes the steps to log_folder/step_timing.csv and the totals to TensorBoard.
+On cuda the device is synchronized at each mark, otherwise the asynchronous kernels would be charged to the next phase
+that waits for them; the training step already synchronizes once per step with loss.item().
+'''
+import os
+import time
+
+import pandas as pd
+import torch
+
+
+class StepTimer():
+    '''
+    enabled=False: every method returns at once, the training loop calls the timer unconditionally.
+    Phases marked between two Step() calls are per step (data, h2d, forward, ...), the marks after the last step of the
+    epoch (metrics, validation, histogram, ...) only go to the epoch total.
+    '''
+    def __init__(self, log_folder, device=None, enabled=True):
+        self.enabled = enabled
+        self.log_path = os.path.join(str(log_folder), 'step_timing.csv')
+        self.device = device
+        self.is_sync = device is not None and torch.device(device).type == 'cuda'
+        self.last = None
+        self.current = {}
+        self.step_list = []
+
+    def _Sync(self):
+        if self.is_sync:
+            torch.cuda.synchronize(self.device)
+
+    def Start(self):
+        if not self.enabled: return
+        self._Sync()
+        self.last = time.perf_counter()
+        self.current = {}
+        self.step_list = []
+
+    def Mark(self, phase):
+        if not self.enabled: return
+        self._Sync()
+        now = time.perf_counter()
+        self.current[phase] = self.current.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def Step(self, n_sample):
+        if not self.enabled: return
+        self.step_list.append(dict(self.current, n_sample=n_sample))
+        self.current = {}
+
+    def Epoch(self, epoch, writer=None):
+        ''' the summary line of the epoch, '' if not enabled '''
+        if not self.enabled: return ''
+        step_df = pd.DataFrame(self.step_list).fillna(0.)
+        step_df.insert(0, 'Step', range(len(step_df)))
+        step_df.insert(0, 'Epoch', epoch + 1)
+        step_df.to_csv(self.log_path, mode='a', header=not os.path.exists(self.log_path), index=False)
+
+        step_time = step_df.drop(columns=['Epoch', 'Step', 'n_sample']).sum()
+        epoch_time = step_time.add(pd.Series(self.current, dtype=float), fill_value=0.)
+        step_total = max(step_time.sum(), 1e-9)
+        data_wait = float(step_time.get('data', 0.) / step_total)
+        samples_per_second = float(step_df['n_sample'].sum() / step_total)
+        if writer is not None:
+            writer.add_scalars('Time', epoch_time.to_dict(), epoch + 1)
+            writer.add_scalar('DataWait', data_wait, epoch + 1)
+            writer.add_scalar('SamplesPerSecond', samples_per_second, epoch + 1)
+        return 'time {:.1f}s ({}); data wait {:.1%}, {:.1f} samples/s'.format(
+            epoch_time.sum(), ', '.join(['{} {:.1f}s'.format(phase, value) for phase, value in epoch_time.items()]),
+            data_wait, samples_per_second)
@@ -0,0 +1,37 @@
+'''
+The validation data of one fold, read once from its loader and kept in memory, so the epochs validate from memory in
+large batches instead of loading and collating the same cases again.
+'''
+import torch
+
+
+class ValidationSet():
+    '''
+    loader: the validation loader of the fold, (inputs, label) batches with the dis_map as the last input.
+    on_device: the tensors are kept on device, otherwise in pinned host memory and copied per batch.
+    '''
+    def __init__(self, loader, device, on_device=True):
+        self.device = device
+        self.on_device = on_device
+        inputs_list, dis_map_list, label_list = [], [], []
+        for inputs, outputs in loader:
+            dis_map_list.append(torch.unsqueeze(inputs[-1], dim=1))
+            inputs_list.append(torch.stack(inputs[:-1], dim=1))
+            label_list.append(outputs)
+        self.inputs = self._Keep(torch.cat(inputs_list))
+        self.dis_map = self._Keep(torch.cat(dis_map_list))
+        self.label = self._Keep(torch.cat(label_list))
+
+    def _Keep(self, tensor):
+        if self.on_device:
+            return tensor.to(self.device)
+        return tensor.pin_memory() if torch.cuda.is_available() else tensor
+
+    def __len__(self):
+        return len(self.label)
+
+    def Batches(self, batch_size):
+        ''' (inputs, dis_map, label) on device, in the order of the loader '''
+        for start in range(0, len(self.label), batch_size):
+            batch = [one[start: start + batch_size] for one in [self.inputs, self.dis_map, self.label]]
+            yield [one.to(self.device, non_blocking=True) for one in batch]
@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+
+class FoldBatchSampler():
+    ''' batches of index_list, index_list / batch_size / shuffle can be changed between two iterations '''
+    def __init__(self):
+        self.index_list = []
+        self.batch_size = 1
+        self.shuffle = False
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.index_list)) if self.shuffle else np.arange(len(self.index_list))
+        for start in range(0, len(order), self.batch_size):
+            yield [self.index_list[one] for one in order[start: start + self.batch_size]]
+
+    def __len__(self):
+        return int(np.ceil(len(self.index_list) / self.batch_size))
+
+
+class _FoldLoader():
+    def __init__(self, pool, index_list, batch_size, shuffle):
+        self.pool = pool
+        self.index_list = index_list
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        return self.pool.Iterate(self.index_list, self.batch_size, self.shuffle)
+
+    def __len__(self):
+        return int(np.ceil(len(self.index_list) / self.batch_size))
+
+
+class PersistentWorkerPool():
+    '''
+    One DataLoader with persistent workers over the dataset of the whole cohort, for the whole cross validation.
+    Each fold (train or val) only swaps the index list of the batch sampler, the workers are started once.
+    The loaders of one pool are iterated one after the other, not at the same time.
+    n_prefetch: batches loaded ahead per worker.
+    '''
+    def __init__(self, dataset, n_workers=8, n_prefetch=2, pin_memory=True):
+        self.sampler = FoldBatchSampler()
+        self.loader = DataLoader(dataset, batch_sampler=self.sampler, num_workers=n_workers, pin_memory=pin_memory,
+                                 persistent_workers=n_workers > 0, prefetch_factor=n_prefetch if n_workers > 0 else None)
+        self.startup_time = None
+
+    def Loader(self, index_list, batch_size, shuffle):
+        ''' (loader, batches) like _GetLoader, index_list indexes the dataset of the pool '''
+        fold_loader = _FoldLoader(self, list(index_list), batch_size, shuffle)
+        return fold_loader, float(len(fold_loader))
+
+    def Iterate(self, index_list, batch_size, shuffle):
+        self.sampler.index_list = index_list
+        self.sampler.batch_size = batch_size
+        self.sampler.shuffle = shuffle
+        if self.startup_time is not None:
+            yield from self.loader
+            return
+
+        # the workers start with the first iteration, the first batch waits for them
+        start = time.time()
+        iterator = iter(self.loader)
+        first = next(iterator, None)
+        self.startup_time = time.time() - start
+        print('worker startup (with the first batch): {:.1f}s'.format(self.startup_time))
+        if first is not None:
+            yield first
+            yield from iterator
@@ -42,12 +42,9 @@ def demo_my(model, input_list, input_class):
 
 
 def GetCenter(roi):
+    from DataPreprocess.RoiGeometry import RoiGeometry, GeometryCenter
     assert (np.ndim(roi) == 3)
-    roi = np.squeeze(roi)
-    non_zero = np.nonzero(roi)
-    center_y = int(np.median(np.unique(non_zero[1])))
-    center_x = int(np.median(np.unique(non_zero[2])))
-    center_z = int(np.median(np.unique(non_zero[0])))
+    center_z, center_y, center_x = GeometryCenter(RoiGeometry(roi))
     return (center_z, center_x, center_y, )
 
 